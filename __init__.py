@@ -1,34 +1,28 @@
-import os
-import json
-
-#check if config file exists
-if not os.path.isfile(os.path.join(os.path.realpath(__file__),"config.json")):
-    #create config file
-    config = {
-        "autoUpdate": True,
-        "branch": "dev",
-        "openAI_API_Key": "sk-#########################################"
-    }
-    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)),"config.json"), "w") as f:
-        json.dump(config, f, indent=4)
-#load config file
-with open(os.path.join(os.path.dirname(os.path.realpath(__file__)),"config.json"), "r") as f:
-    config = json.load(f)
-
-
-
 from .aimusic.gen_lyrics import gen_lyrics
 from .aimusic.gen_lyrics import load_openAI
 from .aimusic.gen_lyrics import analyze_lyrics
+from .aimusic.gen_lyrics import gen_lyrics_batch
+from .aimusic.gen_lyrics import gen_lyrics_and_tags
 from  .aimusic.WanVideoVACEStartToEndFrame import WanVideoVACEStartToEndFrame
+from .aimusic.WanVideoVACEKeyframes import WanVideoVACEKeyframes
+from .aimusic.WanVideoVACESegments import WanVideoVACESegmentPlanner
+from .aimusic.ControlVideoMemmap import LoadControlVideoNpy, SaveControlVideoNpy
 
 NODE_CLASS_MAPPINGS = {
-    "gen_lyrics": gen_lyrics,"load_openAI": load_openAI,"analyze_lyrics": analyze_lyrics,
+    "gen_lyrics": gen_lyrics,"gen_lyrics_batch": gen_lyrics_batch,"gen_lyrics_and_tags": gen_lyrics_and_tags,
+    "load_openAI": load_openAI,"analyze_lyrics": analyze_lyrics,
     "WanVideoVACEStartToEndFrame": WanVideoVACEStartToEndFrame,
+    "WanVideoVACEKeyframes": WanVideoVACEKeyframes,
+    "WanVideoVACESegmentPlanner": WanVideoVACESegmentPlanner,
+    "LoadControlVideoNpy": LoadControlVideoNpy, "SaveControlVideoNpy": SaveControlVideoNpy,
 }
 NODE_DISPLAY_NAME_MAPPINGS = {
-    "gen_lyrics": "歌词生成","load_openAI": "load_openAI","analyze_lyrics": "分析歌词",
-    "WanVideoVACEStartToEndFrame" : "创建首尾帧批次和蒙版"
+    "gen_lyrics": "歌词生成","gen_lyrics_batch": "批量歌词生成","gen_lyrics_and_tags": "歌词生成并分析",
+    "load_openAI": "load_openAI","analyze_lyrics": "分析歌词",
+    "WanVideoVACEStartToEndFrame" : "创建首尾帧批次和蒙版",
+    "WanVideoVACEKeyframes": "创建多关键帧批次和蒙版",
+    "WanVideoVACESegmentPlanner": "长视频分段规划",
+    "LoadControlVideoNpy": "加载控制视频(npy内存映射)", "SaveControlVideoNpy": "保存控制视频(npy)",
 }
 
 __all__ = ['NODE_CLASS_MAPPINGS', 'NODE_DISPLAY_NAME_MAPPINGS']
\ No newline at end of file
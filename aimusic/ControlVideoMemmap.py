@@ -0,0 +1,137 @@
+import os
+
+
+class MemmapFrames:
+    """
+    (N, H, W, C) frames of a memory-mapped .npy file that behave enough like an IMAGE tensor for the
+    VACE frame builders: slicing stays lazy on disk, index_select() and to() read and convert only
+    the frames they return. uint8 frames are scaled to [0, 1] float.
+    """
+
+    def __init__(self, array, path=None, start=0):
+        self.array = array
+        self.path = path
+        self.start = start
+
+    @property
+    def shape(self):
+        import torch
+        return torch.Size(self.array.shape)
+
+    @property
+    def device(self):
+        import torch
+        return torch.device("cpu")
+
+    @property
+    def dtype(self):
+        import torch
+        return torch.float32
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step not in (None, 1):
+            raise TypeError("MemmapFrames only supports contiguous frame slices")
+        start, _, _ = item.indices(len(self))
+        return MemmapFrames(self.array[item], self.path, self.start + start)
+
+    def _convert(self, array):
+        import numpy as np
+        import torch
+        # one read and convert pass into a new, writable float32 array
+        frames = torch.from_numpy(np.array(array, dtype=np.float32))
+        return frames.div_(255.0) if array.dtype == np.uint8 else frames
+
+    def index_select(self, dim, index):
+        if dim != 0:
+            raise ValueError("MemmapFrames can only select frames")
+        return self._convert(self.array[index.cpu().numpy()])
+
+    def to(self, *args, **kwargs):
+        return self._convert(self.array).to(*args, **kwargs)
+
+    def fingerprint(self):
+        mtime = os.path.getmtime(self.path) if self.path else None
+        return (tuple(self.array.shape), str(self.array.dtype), self.path, mtime, self.start)
+
+
+def resolve_npy_path(npy_path):
+    """Relative paths are taken from the ComfyUI output directory, not the working directory"""
+    if os.path.isabs(npy_path):
+        return npy_path
+    import folder_paths
+    return os.path.join(folder_paths.get_output_directory(), npy_path)
+
+
+def load_frames_npy(npy_path):
+    import numpy as np
+    return MemmapFrames(np.load(npy_path, mmap_mode="r"), npy_path)
+
+
+def save_frames_npy(images, npy_path, chunk_size=64):
+    """Write an IMAGE batch to a uint8 .npy file chunk by chunk, without a full uint8 copy in memory"""
+    import numpy as np
+    import torch
+    frames = np.lib.format.open_memmap(npy_path, mode="w+", dtype=np.uint8, shape=tuple(images.shape))
+    for start in range(0, images.shape[0], chunk_size):
+        chunk = images[start:start + chunk_size].clamp(0, 1).mul(255).round().to(torch.uint8)
+        frames[start:start + chunk.shape[0]] = chunk.cpu().numpy()
+    frames.flush()
+    return npy_path
+
+
+class LoadControlVideoNpy:
+    """
+    Memory-map a uint8 (N, H, W, 3) .npy control video for WanVideoVACEStartToEndFrame, which then
+    only reads the frames it places
+    """
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "npy_path": ("STRING", {"multiline": False, "default": "",
+                                        "tooltip": "Relative paths are in the ComfyUI output directory"}),
+            }
+        }
+
+    RETURN_TYPES = ("MMAP_FRAMES", "INT",)
+    RETURN_NAMES = ("control_frames", "frame_count",)
+    FUNCTION = "load"
+    CATEGORY = "aimusic/WanVideoWrapper"
+
+    @classmethod
+    def IS_CHANGED(cls, npy_path):
+        npy_path = resolve_npy_path(npy_path)
+        return os.path.getmtime(npy_path) if os.path.isfile(npy_path) else float("nan")
+
+    def load(self, npy_path):
+        frames = load_frames_npy(resolve_npy_path(npy_path))
+        return (frames, len(frames))
+
+
+class SaveControlVideoNpy:
+    """
+    Save an IMAGE batch as a uint8 .npy control video for LoadControlVideoNpy
+    """
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "images": ("IMAGE",),
+                "npy_path": ("STRING", {"multiline": False, "default": "control_video.npy",
+                                        "tooltip": "Relative paths are in the ComfyUI output directory"}),
+            }
+        }
+
+    OUTPUT_NODE = True
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("npy_path",)
+    FUNCTION = "save"
+    CATEGORY = "aimusic/WanVideoWrapper"
+
+    def save(self, images, npy_path):
+        npy_path = resolve_npy_path(npy_path)
+        os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+        return (save_frames_npy(images, npy_path),)
@@ -0,0 +1,103 @@
+from .WanVideoVACEStartToEndFrame import MASK_FORMATS, OUTPUT_DTYPES
+
+
+def parse_keyframe_indices(keyframe_indices, num_frames):
+    """Parse "0, 40, -1" into frame indices, negative indices count from the end of the batch"""
+    indices = []
+    for item in keyframe_indices.replace("\n", ",").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        index = int(item)
+        if index < 0:
+            index = num_frames + index
+        if not 0 <= index < num_frames:
+            raise ValueError(f"keyframe index {item} is outside of the {num_frames} frame batch")
+        indices.append(index)
+    return indices
+
+
+class WanVideoVACEKeyframes:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {
+            "num_frames": ("INT",
+                           {"default": 81, "min": 1, "max": 10000, "step": 4, "tooltip": "Number of frames to encode"}),
+            "empty_frame_level": ("FLOAT", {"default": 0.5, "min": 0.0, "max": 1.0, "step": 0.01,
+                                            "tooltip": "White level of empty frame to use"}),
+            "keyframes": ("IMAGE", {"tooltip": "Keyframe images, one per index"}),
+            "keyframe_indices": ("STRING", {"default": "0, -1", "multiline": False,
+                                            "tooltip": "Comma separated frame index of every keyframe image, "
+                                                       "negative indices count from the end. Later keyframes "
+                                                       "win on duplicate indices"}),
+        },
+            "optional": {
+                "control_images": ("IMAGE",),
+                "inpaint_mask": ("MASK", {"tooltip": "Inpaint mask to use for the empty frames"}),
+                "keep_device": ("BOOLEAN", {"default": False,
+                                            "tooltip": "Return the batch on the input device and dtype instead of "
+                                                       "copying it to the CPU as float32"}),
+                "output_dtype": (OUTPUT_DTYPES, {"default": "auto",
+                                                 "tooltip": "dtype the batch and float masks are built in. auto: "
+                                                            "float32, or the input dtype with keep_device"}),
+                "mask_format": (MASK_FORMATS, {"default": "float",
+                                               "tooltip": "float: dense mask. uint8/bool: dense 0/1 mask. "
+                                                          "per_frame: (num_frames, 1, 1) flags, dense only "
+                                                          "when an inpaint mask is given"}),
+                "mask_spatial_stride": ("INT", {"default": 1, "min": 1, "max": 16, "step": 1,
+                                                "tooltip": "Output the mask at H/stride x W/stride"}),
+                "mask_temporal_stride": ("INT", {"default": 1, "min": 1, "max": 8, "step": 1,
+                                                 "tooltip": "Output the mask at (num_frames - 1) / stride + 1 "
+                                                            "frames"}),
+            },
+        }
+
+    RETURN_TYPES = ("IMAGE", "MASK",)
+    RETURN_NAMES = ("images", "masks",)
+    FUNCTION = "process"
+    CATEGORY = "aimusic/WanVideoWrapper"
+    DESCRIPTION = "Helper node to place any number of keyframes into one frame batch and build the VACE masks"
+
+    def process(self, num_frames, empty_frame_level, keyframes, keyframe_indices, control_images=None,
+                inpaint_mask=None, keep_device=False, mask_format="float", mask_spatial_stride=1,
+                mask_temporal_stride=1, output_dtype="auto"):
+        import torch
+        from .vace_ops import _Layout, _fill_frames, _format_masks, _inpaint_frames, _output_dtype, _resize_frames
+
+        indices = parse_keyframe_indices(keyframe_indices, num_frames)
+        if len(indices) != keyframes.shape[0]:
+            raise ValueError(f"got {keyframes.shape[0]} keyframes but {len(indices)} keyframe indices")
+
+        _, H, W, _ = keyframes.shape
+        device = keyframes.device
+        dtype = _output_dtype(output_dtype, keep_device, keyframes.dtype)
+        mask_device = device if keep_device else torch.device("cpu")
+        mask_h, mask_w = max(H // mask_spatial_stride, 1), max(W // mask_spatial_stride, 1)
+
+        # Keep the last keyframe per index, index_copy_ is not ordered for duplicate indices
+        last_keyframe = {index: i for i, index in enumerate(indices)}
+        frame_idx = torch.tensor(list(last_keyframe.keys()), dtype=torch.long, device=device)
+        keyframe_idx = torch.tensor(list(last_keyframe.values()), dtype=torch.long, device=device)
+
+        placed = torch.zeros(num_frames, dtype=torch.bool, device=device)
+        placed[frame_idx] = True
+
+        # Scatter all keyframes into one preallocated batch, then fill the gaps with control images
+        out_batch = torch.full((num_frames, H, W, 3), empty_frame_level, dtype=dtype, device=device)
+        out_batch.index_copy_(0, frame_idx, keyframes.index_select(0, keyframe_idx).to(out_batch))
+        if control_images is not None:
+            control_images = control_images[:num_frames]
+        if isinstance(control_images, torch.Tensor):
+            # resized whole, one resize_cache entry per control video
+            control_images = _resize_frames(control_images, W, H, "lanczos")
+        layout = _Layout(H, W, device, dtype, [], placed, ~placed, control_images, inpaint_mask, True)
+        _fill_frames(out_batch, 0, layout)
+
+        if inpaint_mask is not None:
+            inpaint_mask = _inpaint_frames(inpaint_mask, 0, num_frames, mask_h, mask_w, mask_device)
+        masks = _format_masks(layout.generate.to(mask_device), mask_h, mask_w, mask_format, dtype, inpaint_mask,
+                              temporal_stride=mask_temporal_stride)
+
+        if keep_device:
+            return (out_batch, masks)
+        return (out_batch.cpu(), masks)
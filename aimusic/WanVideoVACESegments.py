@@ -0,0 +1,160 @@
+from .WanVideoVACEStartToEndFrame import MASK_FORMATS, OUTPUT_DTYPES
+
+
+def plan_segments(total_frames, window_size, overlap):
+    """
+    Split total_frames into overlapping [start, end) windows of window_size frames, every window
+    after the first starts overlap frames before the end of the previous one. The last window ends at
+    total_frames and starts earlier if needed, so all windows keep Wan's 4k+1 frame count.
+    """
+    if window_size % 4 != 1:
+        raise ValueError(f"window_size must be 4k+1 frames, got {window_size}")
+    if not 0 <= overlap < window_size:
+        raise ValueError(f"overlap must be in [0, {window_size}), got {overlap}")
+    if total_frames <= window_size:
+        if total_frames % 4 != 1:
+            raise ValueError(f"total_frames shorter than window_size must be 4k+1 frames, got {total_frames}")
+        return [(0, total_frames)]
+    segments = []
+    start = 0
+    while start + window_size < total_frames:
+        segments.append((start, start + window_size))
+        start += window_size - overlap
+    # the last window overlaps the previous one by more than overlap frames instead of being shorter
+    segments.append((total_frames - window_size, total_frames))
+    return segments
+
+
+class VACESegmentPlan:
+    """
+    All segment boundaries of a long VACE generation, computed up front. The control video is
+    resized once for the whole video on first use and every segment slices it, the frames and
+    masks of a segment are only built when segment() is called.
+    """
+
+    def __init__(self, total_frames, window_size, overlap, control_images=None, width=0, height=0):
+        self.segments = plan_segments(total_frames, window_size, overlap)
+        self.control_images = control_images
+        self.width = width or (control_images.shape[2] if control_images is not None else 0)
+        self.height = height or (control_images.shape[1] if control_images is not None else 0)
+        self._resized_control = None
+
+    def __len__(self):
+        return len(self.segments)
+
+    def overlap(self, index):
+        """Frames segment index shares with the previous segment, more than overlap for the last one"""
+        return self.segments[index - 1][1] - self.segments[index][0] if index > 0 else 0
+
+    def resized_control(self):
+        if self._resized_control is None and self.control_images is not None:
+            from .vace_ops import _resize_frames
+            # kept by the plan, not in resize_cache
+            self._resized_control = _resize_frames(self.control_images, self.width, self.height, "lanczos",
+                                                   cache=False)
+        return self._resized_control
+
+    def segment(self, index, empty_frame_level, previous_frames=None, dtype=None, device=None,
+                mask_format="float"):
+        """
+        Frames and masks of segment index. The frames of previous_frames, the output of the previous
+        segment, that this segment overlaps are placed at its start as anchors with mask 0; the rest is
+        filled from the control video or empty_frame_level and masked with 1. dtype defaults to float32.
+        """
+        import torch
+        from .vace_ops import _Layout, _fill_frames, _format_masks, _resize_frames
+
+        dtype = dtype or torch.float32
+        start, end = self.segments[index]
+        num_frames = end - start
+        control = self.resized_control()
+        width, height = self.width, self.height
+        if not width or not height:
+            if previous_frames is None:
+                raise ValueError("segment size is unknown without control_images, previous_frames or width/height")
+            height, width = previous_frames.shape[1:3]
+        if device is None:
+            if control is not None:
+                device = control.device
+            elif previous_frames is not None:
+                device = previous_frames.device
+            else:
+                device = torch.device("cpu")
+
+        placements = []
+        overlap = self.overlap(index)
+        if previous_frames is not None and overlap > 0:
+            anchors = previous_frames[-min(overlap, previous_frames.shape[0], num_frames):]
+            placements.append((0, _resize_frames(anchors, width, height, "lanczos", cache=False)))
+        placed = torch.zeros(num_frames, dtype=torch.bool, device=device)
+        for first, frames in placements:
+            placed[first:first + frames.shape[0]] = True
+        layout = _Layout(height, width, device, dtype, placements, placed, ~placed,
+                         control[start:end] if control is not None else None, None, False)
+
+        images = torch.full((num_frames, height, width, 3), empty_frame_level, dtype=dtype, device=device)
+        _fill_frames(images, 0, layout)
+        masks = _format_masks(layout.generate, height, width, mask_format, dtype)
+        return images, masks
+
+
+# the plan of the last planner run, so the control video is resized once for all of its segments
+_last_plan = {}
+
+
+def get_segment_plan(total_frames, window_size, overlap, control_images=None, width=0, height=0):
+    # the plan keeps a reference to control_images, so its id can't be reused while it is cached
+    key = (total_frames, window_size, overlap, id(control_images), width, height)
+    plan = _last_plan.get(key)
+    if plan is None:
+        plan = VACESegmentPlan(total_frames, window_size, overlap, control_images, width, height)
+        _last_plan.clear()
+        _last_plan[key] = plan
+    return plan
+
+
+class WanVideoVACESegmentPlanner:
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {
+            "total_frames": ("INT", {"default": 241, "min": 1, "max": 100000, "step": 1,
+                                     "tooltip": "Length of the whole video"}),
+            "window_size": ("INT", {"default": 81, "min": 1, "max": 10000, "step": 4,
+                                    "tooltip": "Frames per generated segment, 4k+1"}),
+            "overlap": ("INT", {"default": 16, "min": 0, "max": 10000, "step": 1,
+                                "tooltip": "Frames shared by consecutive segments"}),
+            "segment_index": ("INT", {"default": 0, "min": 0, "max": 10000, "step": 1,
+                                      "tooltip": "Segment to build"}),
+            "empty_frame_level": ("FLOAT", {"default": 0.5, "min": 0.0, "max": 1.0, "step": 0.01,
+                                            "tooltip": "White level of empty frame to use"}),
+        },
+            "optional": {
+                "control_images": ("IMAGE", {"tooltip": "Control video for the whole length, resized once"}),
+                "previous_frames": ("IMAGE", {"tooltip": "Output of the previous segment, its last overlap "
+                                                         "frames become the start anchors"}),
+                "width": ("INT", {"default": 0, "min": 0, "max": 8192, "step": 8,
+                                  "tooltip": "Segment width, 0 uses the control video size"}),
+                "height": ("INT", {"default": 0, "min": 0, "max": 8192, "step": 8,
+                                   "tooltip": "Segment height, 0 uses the control video size"}),
+                "mask_format": (MASK_FORMATS, {"default": "float"}),
+                "output_dtype": (OUTPUT_DTYPES, {"default": "auto", "tooltip": "auto: float32"}),
+            },
+        }
+
+    RETURN_TYPES = ("IMAGE", "MASK", "INT", "INT", "INT",)
+    RETURN_NAMES = ("images", "masks", "segment_start", "segment_frames", "num_segments",)
+    FUNCTION = "process"
+    CATEGORY = "aimusic/WanVideoWrapper"
+    DESCRIPTION = "Plan overlapping VACE segments of a long video and build the frames and masks of one segment"
+
+    def process(self, total_frames, window_size, overlap, segment_index, empty_frame_level, control_images=None,
+                previous_frames=None, width=0, height=0, mask_format="float", output_dtype="auto"):
+        plan = get_segment_plan(total_frames, window_size, overlap, control_images, width, height)
+        if segment_index >= len(plan):
+            raise ValueError(f"segment_index {segment_index} is out of range, the plan has {len(plan)} segments")
+        from .vace_ops import _output_dtype
+
+        images, masks = plan.segment(segment_index, empty_frame_level, previous_frames,
+                                     dtype=_output_dtype(output_dtype, False, None), mask_format=mask_format)
+        start, end = plan.segments[segment_index]
+        return (images.cpu(), masks.cpu(), start, end - start, len(plan))
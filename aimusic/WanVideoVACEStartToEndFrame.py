@@ -1,6 +1,17 @@
-import torch
-import numpy as np
-from comfy.utils import common_upscale
+MASK_FORMATS = ["float", "uint8", "bool", "per_frame"]
+# auto: float32, or the input dtype with keep_device
+OUTPUT_DTYPES = ["auto", "float32", "float16", "bfloat16"]
+
+
+def __getattr__(name):
+    # expand_vace_mask, iter_vace_windows and the other helpers live in vace_ops, which loads torch.
+    # The import system probes dunders like __path__, those must not trigger the import
+    if name.startswith("__"):
+        raise AttributeError(name)
+    from . import vace_ops
+    return getattr(vace_ops, name)
+
+
 class WanVideoVACEStartToEndFrame:
     @classmethod
     def INPUT_TYPES(s):
@@ -14,11 +25,40 @@ class WanVideoVACEStartToEndFrame:
                 "start_image": ("IMAGE",),
                 "end_image": ("IMAGE",),
                 "control_images": ("IMAGE",),
+                "control_frames": ("MMAP_FRAMES", {"tooltip": "Memory-mapped control video from "
+                                                              "LoadControlVideoNpy, used instead of control_images. "
+                                                              "Only the frames that are placed are read"}),
                 "inpaint_mask": ("MASK", {"tooltip": "Inpaint mask to use for the empty frames"}),
                 "start_index": ("INT",
                                 {"default": 0, "min": 0, "max": 10000, "step": 1, "tooltip": "Index to start from"}),
                 "end_index": ("INT",
                               {"default": -1, "min": -10000, "max": 10000, "step": 1, "tooltip": "Index to end at"}),
+                "keep_device": ("BOOLEAN", {"default": False,
+                                            "tooltip": "Return the batch on the input device and dtype instead of "
+                                                       "copying it to the CPU as float32"}),
+                "output_dtype": (OUTPUT_DTYPES, {"default": "auto",
+                                                 "tooltip": "dtype the batch and float masks are built in. auto: "
+                                                            "float32, or the input dtype with keep_device"}),
+                "memoize": ("BOOLEAN", {"default": False,
+                                        "tooltip": "Reuse the output of earlier runs with identical inputs"}),
+                "mask_format": (MASK_FORMATS, {"default": "float",
+                                               "tooltip": "float: dense mask. uint8/bool: dense 0/1 mask. "
+                                                          "per_frame: (num_frames, 1, 1) flags, dense only "
+                                                          "when an inpaint mask is given"}),
+                "mask_spatial_stride": ("INT", {"default": 1, "min": 1, "max": 16, "step": 1,
+                                                "tooltip": "Output the mask at H/stride x W/stride, e.g. 8 for "
+                                                           "the VAE latent grid. The inpaint mask is resized "
+                                                           "straight to that size"}),
+                "mask_temporal_stride": ("INT", {"default": 1, "min": 1, "max": 8, "step": 1,
+                                                 "tooltip": "Output the mask at (num_frames - 1) / stride + 1 "
+                                                            "frames, e.g. 4 for the VAE latent frames"}),
+                "chunk_size": ("INT", {"default": 0, "min": 0, "max": 10000, "step": 1,
+                                       "tooltip": "Build the batch in windows of this many frames and write it to "
+                                                  "a memory-mapped .npy file, 0 builds it in memory at once"}),
+                "output_npy": ("STRING", {"default": "",
+                                          "tooltip": "Path of the .npy file for chunk_size > 0, masks go next to "
+                                                     "it as *_masks.npy. Empty uses a file in the ComfyUI temp directory "
+                                                     "that the next run replaces"}),
             },
         }
 
@@ -29,83 +69,22 @@ class WanVideoVACEStartToEndFrame:
     DESCRIPTION = "Helper node to create start/end frame batch and masks for VACE"
 
     def process(self, num_frames, empty_frame_level, start_image=None, end_image=None, control_images=None,
-                inpaint_mask=None, start_index=0, end_index=-1):
-
-        if start_image is None and end_image is None and control_images is not None:
-            if control_images.shape[0] >= num_frames:
-                control_images = control_images[:num_frames]
-            elif control_images.shape[0] < num_frames:
-                # padd with empty_frame_level frames
-                padding = torch.ones(
-                    (num_frames - control_images.shape[0], control_images.shape[1], control_images.shape[2],
-                     control_images.shape[3]), device=control_images.device) * empty_frame_level
-                control_images = torch.cat([control_images, padding], dim=0)
-            return (control_images.cpu().float(), torch.zeros_like(control_images[:, :, :, 0]).cpu().float())
-        B, H, W, C = start_image.shape if start_image is not None else end_image.shape
-        device = start_image.device if start_image is not None else end_image.device
-
-        # Convert negative end_index to positive
-        if end_index < 0:
-            end_index = num_frames + end_index
-
-        # Create output batch with empty frames
-        out_batch = torch.ones((num_frames, H, W, 3), device=device) * empty_frame_level
-
-        # Create mask tensor with proper dimensions
-        masks = torch.ones((num_frames, H, W), device=device)
-
-        # Pre-process all images at once to avoid redundant work
-        if end_image is not None and (end_image.shape[1] != H or end_image.shape[2] != W):
-            end_image = common_upscale(end_image.movedim(-1, 1), W, H, "lanczos", "disabled").movedim(1, -1)
-
-        if control_images is not None and (control_images.shape[1] != H or control_images.shape[2] != W):
-            control_images = common_upscale(control_images.movedim(-1, 1), W, H, "lanczos", "disabled").movedim(1, -1)
-
-        # Place start image at start_index
-        if start_image is not None:
-            frames_to_copy = min(start_image.shape[0], num_frames - start_index)
-            if frames_to_copy > 0:
-                out_batch[start_index:start_index + frames_to_copy] = start_image[:frames_to_copy]
-                masks[start_index:start_index + frames_to_copy] = 0
-
-        # Place end image at end_index
-        if end_image is not None:
-            # Calculate where to start placing end images
-            end_start = end_index - end_image.shape[0] + 1
-            if end_start < 0:  # Handle case where end images won't all fit
-                end_image = end_image[abs(end_start):]
-                end_start = 0
-
-            frames_to_copy = min(end_image.shape[0], num_frames - end_start)
-            if frames_to_copy > 0:
-                out_batch[end_start:end_start + frames_to_copy] = end_image[:frames_to_copy]
-                masks[end_start:end_start + frames_to_copy] = 0
-
-        # Apply control images to remaining frames that don't have start or end images
-        if control_images is not None:
-            # Create a mask of frames that are still empty (mask == 1)
-            empty_frames = masks.sum(dim=(1, 2)) > 0.5 * H * W
-
-            if empty_frames.any():
-                # Only apply control images where they exist
-                control_length = control_images.shape[0]
-                for frame_idx in range(num_frames):
-                    if empty_frames[frame_idx] and frame_idx < control_length:
-                        out_batch[frame_idx] = control_images[frame_idx]
-
-        # Apply inpaint mask if provided
-        if inpaint_mask is not None:
-            inpaint_mask = common_upscale(inpaint_mask.unsqueeze(1), W, H, "nearest-exact", "disabled").squeeze(1).to(
-                device)
-
-            # Handle different mask lengths efficiently
-            if inpaint_mask.shape[0] > num_frames:
-                inpaint_mask = inpaint_mask[:num_frames]
-            elif inpaint_mask.shape[0] < num_frames:
-                repeat_factor = (num_frames + inpaint_mask.shape[0] - 1) // inpaint_mask.shape[0]  # Ceiling division
-                inpaint_mask = inpaint_mask.repeat(repeat_factor, 1, 1)[:num_frames]
-
-            # Apply mask in one operation
-            masks = inpaint_mask * masks
-
-        return (out_batch.cpu().float(), masks.cpu().float())
+                inpaint_mask=None, start_index=0, end_index=-1, keep_device=False,
+                mask_format="float", mask_spatial_stride=1, mask_temporal_stride=1, chunk_size=0, output_npy="",
+                output_dtype="auto", memoize=False, control_frames=None):
+        from . import vace_ops
+
+        if control_frames is not None:
+            control_images = control_frames
+        if chunk_size > 0:
+            return vace_ops.write_chunked(num_frames, empty_frame_level, chunk_size, output_npy, mask_format,
+                                          mask_spatial_stride, mask_temporal_stride,
+                                          vace_ops._output_dtype(output_dtype, False, None), start_image=start_image,
+                                          end_image=end_image, control_images=control_images,
+                                          inpaint_mask=inpaint_mask, start_index=start_index, end_index=end_index)
+
+        args = (num_frames, empty_frame_level, start_image, end_image, control_images, inpaint_mask, start_index,
+                end_index, keep_device, mask_format, mask_spatial_stride, mask_temporal_stride, output_dtype)
+        if memoize:
+            return vace_ops.build_memoized(*args)
+        return vace_ops.build_batch(*args)
@@ -0,0 +1,125 @@
+"""
+Plugin settings, shared by all nodes.
+
+<plugin>/config.json is read on first use and re-read only when its mtime changes. The mtime is
+checked at most every CHECK_INTERVAL seconds, so node executions normally do no file I/O for
+configuration. Nothing here writes the file: missing keys fall back to DEFAULTS, and the AIMUSIC_*
+environment variables in ENV_OVERRIDES take precedence over both.
+"""
+import json
+import os
+import threading
+import time
+
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "config.json")
+CHECK_INTERVAL = 2.0
+
+DEFAULTS = {
+    "openAI_API_Key": "",
+    # VACE nodes, read when they first run
+    # one 81-frame 720p float32 control batch is 854 MB
+    "resize_cache_mb": 1024.0,
+    "output_cache_mb": 4096.0,
+    "resize_chunk_frames": 16,
+    "resize_threads": min(4, os.cpu_count() or 1),
+    # LLM nodes, connection pool settings apply to clients created afterwards
+    "model_list_ttl": 24 * 3600.0,
+    "llm_max_connections": 20,
+    "llm_timeout": 120.0,
+    "llm_connect_timeout": 10.0,
+    "llm_keepalive_expiry": 60.0,
+    "llm_client_idle_timeout": 1800.0,
+    "llm_deadline": 300.0,
+    "llm_max_attempts": 4,
+    "llm_backoff_base": 1.0,
+    "llm_backoff_max": 30.0,
+    "llm_retry_budget_min": 3,
+    "llm_retry_budget_ratio": 0.2,
+    "llm_breaker_failures": 5,
+    "llm_breaker_cooldown": 30.0,
+    "llm_rpm": 0.0,
+    "llm_tpm": 0.0,
+    "llm_rate_limits": {},
+    "llm_completion_tokens": 1500,
+    "llm_cache_mb": 256.0,
+    "llm_cache_max_age": 30 * 24 * 3600.0,
+    # analyze_lyrics asks the LLM only for features analyzed locally with a lower confidence,
+    # 0 never calls it and 1 always does. lyrics_analyzer_thresholds overrides it per feature: the
+    # lyrics rarely tell genre, instrumentation and singer, so by default the local guess (pop
+    # and its instrumentation, the gender hinted at or male) is kept for them. An empty {} applies
+    # lyrics_analyzer_threshold to every feature
+    "lyrics_analyzer_threshold": 0.6,
+    "lyrics_analyzer_thresholds": {"genre": 0.0, "instrumentation": 0.0, "timbre": 0.4, "gender_suggestion": 0.0},
+}
+ENV_OVERRIDES = {
+    "resize_cache_mb": "AIMUSIC_RESIZE_CACHE_MB",
+    "output_cache_mb": "AIMUSIC_OUTPUT_CACHE_MB",
+    "resize_chunk_frames": "AIMUSIC_RESIZE_CHUNK_FRAMES",
+    "resize_threads": "AIMUSIC_RESIZE_THREADS",
+    "model_list_ttl": "AIMUSIC_MODEL_LIST_TTL",
+}
+
+_lock = threading.Lock()
+_config = None
+_mtime = None
+_checked = 0.0
+
+
+def _read(previous):
+    try:
+        with open(CONFIG_PATH, "r", encoding="utf-8") as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        # keep the last good settings while the file is being edited
+        print(f"Error: could not read {CONFIG_PATH}: {e}")
+        return previous if previous is not None else {}
+    if not isinstance(config, dict):
+        print(f"Error: {CONFIG_PATH} must contain a JSON object")
+        return previous if previous is not None else {}
+    return config
+
+
+def _current():
+    global _config, _mtime, _checked
+    now = time.monotonic()
+    if _config is not None and now - _checked < CHECK_INTERVAL:
+        return _config
+    with _lock:
+        if _config is None or now - _checked >= CHECK_INTERVAL:
+            _checked = now
+            try:
+                mtime = os.stat(CONFIG_PATH).st_mtime_ns
+            except OSError:
+                mtime = None
+            if _config is None or mtime != _mtime:
+                _config = _read(_config)
+                _mtime = mtime
+        return _config
+
+
+def reload():
+    """Re-read config.json now instead of on the next mtime check"""
+    global _config
+    with _lock:
+        _config = None
+    return _current()
+
+
+def get(key, default=None):
+    """
+    Setting key from the environment override, config.json or DEFAULTS, in that order.
+    Settings with a default are converted to its type, an invalid value falls back to the default.
+    """
+    if key in ENV_OVERRIDES and ENV_OVERRIDES[key] in os.environ:
+        value = os.environ[ENV_OVERRIDES[key]]
+    else:
+        value = _current().get(key, DEFAULTS.get(key, default))
+    if DEFAULTS.get(key) is not None and value is not None:
+        try:
+            return type(DEFAULTS[key])(value)
+        except (TypeError, ValueError):
+            print(f"Error: invalid value {value!r} for {key}, using {DEFAULTS[key]!r}")
+            return DEFAULTS[key]
+    return value
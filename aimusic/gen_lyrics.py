@@ -1,11 +1,14 @@
 import json
-import os
 from typing import Dict, Any, List, Optional
-import comfy.samplers
-import comfy.sd
-import comfy.utils
 import re
-import importlib
+from concurrent.futures import ThreadPoolExecutor
+from . import config
+from .llm_cache import response_cache, response_key
+from .llm_call import chat_completion, single_flight
+from .llm_client import get_client, resolve_client
+from .llm_models import get_cached_models, refresh_models_async
+from .llm_ratelimit import PRIORITIES
+from .lyrics_analyzer import LyricsAnalyzer
 # 名词定义
 # “悲伤的”、“情绪的”、“愤怒的”、“快乐的”、“令人振奋的”、“强烈的”、“浪漫的”、“忧郁的”
 EMOTIONS = [
@@ -349,43 +352,12 @@ SECTION_DEFINITIONS = {
 }
 openAI_gpt_models = ['gpt-4o', 'gpt-4.1',"deepseek-r1-0528"]
 def get_api_key():
-    # Helper function to get the API key from the file
-    try:
-        # open config file
-        configPath = os.path.join("./", "config.json")
-        with open(configPath, 'r') as f:  # Open the file and read the API key
-            config = json.load(f)
-        api_key = config["openAI_API_Key"]
-    except:
-        print("Error: OpenAI API key file not found OpenAI features wont work for you")
+    # Helper function to get the API key from the plugin config.json, cached by the config module
+    api_key = config.get("openAI_API_Key")
+    if not api_key:
+        print("Error: openAI_API_Key is not set in config.json OpenAI features wont work for you")
         return ""
     return api_key  # Return the API key
-def get_openAI_models():
-    global openAI_models
-    if (openAI_models != None):
-        return openAI_models
-
-    install_openai()
-    from openai import OpenAI
-    # Get the API key from the file
-    api_key = get_api_key()
-    client = OpenAI(
-                # This is the default and can be omitted
-                api_key=api_key,
-            )
-
-    try:
-        models = client.models.list()  # Get the list of models
-        print("all models:",models)
-    except:
-        print("Error: OpenAI API key is invalid OpenAI features wont work for you")
-        return []
-
-    openAI_models = []  # Create a list for the chat models
-    for model in getattr(models, "data"):  # Loop through the models
-        openAI_models.append(getattr(model, "id"))  # Add the model to the list
-
-    return openAI_gpt_models  # Return the list of chat models
 def parse_duration_to_seconds(duration_str: str) -> int:
     """将中文时长字符串转换为秒数"""
     try:
@@ -480,27 +452,27 @@ def generate_lyrics_with_duration(
             f"请根据以下要求生成一首中文歌曲的完整歌词：\n"
             f"主题：{lyric_prompt}",
             f"""歌曲结构：
-            {", ".join([f"[{section}]" for section in template["sections"]])}
-            具体要求：
-            1. 严格按照给定的结构标签分段
-            2. 器乐段落([intro-*]/[outro-*])不需要填歌词
-            3. 人声段落([verse]/[chorus]/[bridge])必须包含歌词
-            4. 主歌([verse])每段4-8行
-            5. 副歌([chorus])要突出高潮部分
-            6. 桥段([bridge])2-4行
-            7. 整体要有押韵和节奏感
-            8. 不要包含歌曲标题
-            9. 不要包含韵脚分析等额外说明
-            返回格式示例：
-            [intro-medium]
-            [verse]
-            第一行歌词
-            第二行歌词
-            ...
-            [chorus]
-            副歌第一行
-            副歌第二行
-            ...""",
+                    {", ".join([f"[{section}]" for section in template["sections"]])}
+                    具体要求：
+                    1. 严格按照给定的结构标签分段
+                    2. 器乐段落([intro-*]/[outro-*])不需要填歌词
+                    3. 人声段落([verse]/[chorus]/[bridge])必须包含歌词
+                    4. 主歌([verse])每段4-8行
+                    5. 副歌([chorus])要突出高潮部分
+                    6. 桥段([bridge])2-4行
+                    7. 整体要有押韵和节奏感
+                    8. 不要包含歌曲标题
+                    9. 不要包含韵脚分析等额外说明
+                    返回格式示例：
+                    [intro-medium]
+                    [verse]
+                    第一行歌词
+                    第二行歌词
+                    ...
+                    [chorus]
+                    副歌第一行
+                    副歌第二行
+                    ...""",
             f"总时长：{song_length} ({total_seconds}秒)",
             "段落时长分配："
         ]
@@ -526,82 +498,327 @@ def generate_lyrics_with_duration(
     except Exception as e:
         print("error")
         return None
-def install_openai():
-    # Helper function to install the OpenAI module if not already installed
-    try:
-        importlib.import_module('openai')
-    except ImportError:
-        import pip
-        pip.main(['install', 'openai'])
 def get_gpt_models():
-    global openAI_gpt_models
-    if (openAI_gpt_models is not None):
-        return openAI_gpt_models
-    models = get_openAI_models()
-    openAI_gpt_models = ["gpt-3.5-turbo"]  # Create a list for the chat models
-    for model in models:  # Loop through the models
-        openAI_gpt_models.append(model)
-    return openAI_gpt_models  # Return the list of chat models
-def clean_generated_lyrics(raw_lyrics: str) -> str:
+    # Static models plus the lists cached on disk, load_openAI refreshes them in the background
+    return get_cached_models(openAI_gpt_models)
+class LyricsCleaner:
     """
-    Format raw lyrics into a single-line string with strict section formatting:
-    - Sections separated by ' ; '
-    - Each line in vocal sections ends with a period
-    - No spaces around periods
-    - Instrumental sections without content
-
-    Args:
-        raw_lyrics: Raw lyrics text with section markers
-
-    Returns:
-        A single-line formatted string
+    Incremental form of clean_generated_lyrics: feed() takes the raw lyrics in pieces of any size,
+    e.g. streamed tokens, and cleans every line as soon as it is complete. finish() returns what
+    clean_generated_lyrics returns for the concatenated pieces.
     """
-    sections = []
-    current_section = None
-    current_lines = []
-
     # 需要统一替换为句号的中文标点符号
     punctuation_to_dot = ['，', '。', '！', '？', '；', '：', '、', '「', '」', '『', '』', '（', '）', '《', '》', '——', '…', '“', '”', '‘', '’']
 
-    for line in raw_lyrics.split('\n'):
+    def __init__(self):
+        self.sections = []
+        self.headers = []  # 已开始的段落名，按顺序
+        self.current_section = None
+        self.current_lines = []
+        self._pending = ""
+
+    @staticmethod
+    def section_header(line):
+        # Detect section headers like [verse]
+        section_match = re.match(r'^\[([a-z\-]+)\]$', line.strip())
+        return section_match.group(1) if section_match else None
+
+    def feed(self, text):
+        """Clean the lines completed by text, returns the names of the sections they closed"""
+        *lines, self._pending = (self._pending + text).split('\n')
+        closed = [self._line(line) for line in lines]
+        return [name for name in closed if name is not None]
+
+    def finish(self):
+        self._line(self._pending)
+        self._pending = ""
+        # 处理最后一个段落
+        self._close_section()
+        # 用 ' ; ' 连接所有段落，返回单行字符串
+        return ' ; '.join(self.sections)
+
+    def _close_section(self):
+        closed = self.current_section
+        if closed is not None:
+            if self.current_lines:
+                # 处理每行结尾加句号，且无空格
+                formatted_lines = [l.rstrip('.') + '.' for l in self.current_lines]
+                section_text = ' '.join(formatted_lines)
+            else:
+                section_text = ''
+            self.sections.append(f"[{closed}]{section_text}")
+            self.current_section = None
+        return closed
+
+    def _line(self, line):
         line = line.strip()
         if not line:
-            continue
-        # Detect section headers like [verse]
-        section_match = re.match(r'^\[([a-z\-]+)\]$', line)
-        if section_match:
+            return None
+        header = self.section_header(line)
+        if header:
             # Save previous section if exists
-            if current_section is not None:
-                if current_lines:
-                    # 处理每行结尾加句号，且无空格
-                    formatted_lines = [l.rstrip('.') + '.' for l in current_lines]
-                    section_text = ' '.join(formatted_lines)
-                else:
-                    section_text = ''
-                sections.append(f"[{current_section}]{section_text}")
-            current_section = section_match.group(1)
-            current_lines = []
-        elif current_section is not None:
+            closed = self._close_section()
+            self.current_section = header
+            self.current_lines = []
+            self.headers.append(header)
+            return closed
+        if self.current_section is not None:
             # 替换所有指定中文标点为句号
             cleaned_line = line
-            for p in punctuation_to_dot:
+            for p in self.punctuation_to_dot:
                 cleaned_line = cleaned_line.replace(p, '.')
             # 替换空格为句号，去除多余句号和空格
             cleaned_line = cleaned_line.replace(' ', '.').strip('. ')
             # 合并连续多个句号为一个
             cleaned_line = re.sub(r'\.+', '.', cleaned_line)
             if cleaned_line:
-                current_lines.append(cleaned_line)
-    # 处理最后一个段落
-    if current_section is not None:
-        if current_lines:
-            formatted_lines = [l.rstrip('.') + '.' for l in current_lines]
-            section_text = ' '.join(formatted_lines)
+                self.current_lines.append(cleaned_line)
+        return None
+def clean_generated_lyrics(raw_lyrics: str) -> str:
+    """
+    Format raw lyrics into a single-line string with strict section formatting:
+    - Sections separated by ' ; '
+    - Each line in vocal sections ends with a period
+    - No spaces around periods
+    - Instrumental sections without content
+
+    Args:
+        raw_lyrics: Raw lyrics text with section markers
+
+    Returns:
+        A single-line formatted string
+    """
+    cleaner = LyricsCleaner()
+    cleaner.feed(raw_lyrics)
+    return cleaner.finish()
+def stream_lyrics(client, model, prompt, sections, priority="interactive"):
+    """
+    Stream the completion of prompt through a LyricsCleaner, advancing the ComfyUI progress bar
+    per finished section. Reading stops once the last section of the template is done, so the
+    model doesn't spend tokens on trailing chatter.
+
+    Returns:
+        (raw lyrics read, cleaned lyrics), clean_generated_lyrics(raw) gives the same cleaned lyrics
+    """
+    from comfy.utils import ProgressBar
+
+    last = sections[-1]
+    last_count = sections.count(last)
+    # 器乐段落没有歌词，它的标签行一到就算完成
+    last_has_lyrics = MUSIC_SECTION_TEMPLATES.get(last, {}).get("lyric_required", True)
+    pbar = ProgressBar(len(sections))
+    cleaner = LyricsCleaner()
+    raw_lines = []
+
+    def take(line):
+        # True once the last section of the template is done
+        last_started = cleaner.headers.count(last) >= last_count
+        if last_started and cleaner.section_header(line) is not None:
+            return True
+        raw_lines.append(line)
+        closed = cleaner.feed(line + '\n')
+        if closed:
+            pbar.update(len(closed))
+        return not last_has_lyrics and cleaner.headers.count(last) >= last_count
+
+    stream = chat_completion(
+        client,
+        priority=priority,
+        model=model,
+        messages=[{"role": "user", "content": prompt}],
+        stream=True
+    )
+    pending = ""
+    try:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            *lines, pending = (pending + (chunk.choices[0].delta.content or "")).split('\n')
+            if any(take(line) for line in lines):
+                break
         else:
-            section_text = ''
-        sections.append(f"[{current_section}]{section_text}")
-    # 用 ' ; ' 连接所有段落，返回单行字符串
-    return ' ; '.join(sections)
+            take(pending)
+    finally:
+        # 提前结束时关闭连接，服务端停止生成
+        stream.close()
+    lyrics = cleaner.finish()
+    pbar.update_absolute(len(sections))
+    return '\n'.join(raw_lines), lyrics
+# 中文结构名到英文键的映射
+STRUCTURE_NAME_MAP = {
+    "流行基础结构": "pop_basic",
+    "流行带桥段结构": "pop_with_bridge",
+    "流行带预副歌结构": "pop_with_prechorus",
+    "流行双副歌结构": "pop_doublechorus",
+    "流行带后副歌结构": "pop_postchorus",
+    "中国民谣结构": "chinese_folk",
+    "戏曲结构": "chinese_opera",
+    "古琴曲结构": "guqin",
+    "民族融合结构": "ethnic_fusion",
+    "中国流行结构": "chinese_pop",
+    "蒙古呼麦结构": "mongolian_throat",
+    "经典摇滚结构": "rock_classic",
+    "前卫金属结构": "metal_progressive",
+    "朋克结构": "punk",
+    "硬摇滚结构": "hardrock",
+    "摇滚抒情曲结构": "rock_ballad",
+    "金属核结构": "metalcore",
+    "蓝调摇滚结构": "blues_rock",
+    "摇滚器乐曲结构": "rock_instrumental",
+    "EDM构建-高潮结构": "edm_builddrop",
+    "浩室结构": "house",
+    "回响贝斯结构": "dubstep",
+    "科技结构": "techno",
+    "鼓打贝斯结构": "drum_bass",
+    "氛围结构": "ambient",
+    "经典嘻哈结构": "hiphop_classic",
+    "陷阱结构": "trap",
+    "叙事说唱结构": "rap_storytelling",
+    "爵士嘻哈结构": "hiphop_jazzy",
+    "对战说唱结构": "rap_battle",
+    "爵士标准结构": "jazz_standard",
+    "12小节蓝调结构": "blues_12bar",
+    "爵士融合结构": "jazz_fusion",
+    "比博普结构": "bebop",
+    "爵士抒情曲结构": "jazz_ballad",
+}
+def get_structure_template(Lyric_structure):
+    key = STRUCTURE_NAME_MAP.get(Lyric_structure)
+    if key is None:
+        raise ValueError(f"未知的歌词结构: {Lyric_structure}")
+    return STRUCTURE_TEMPLATES[key]
+def request_lyrics(client, model, prompt, sections, variant=0, force_regenerate=False, stream=False,
+                   priority="interactive"):
+    """
+    Cleaned lyrics for prompt, from the response cache or the model. Each variant is a separate
+    completion of the same prompt with its own cache entry, variant 0 shares the entry of gen_lyrics.
+    Concurrent calls for the same entry share one request.
+    """
+    # 相同 base_url/模型/提示词的结果直接从缓存返回
+    cache_key = response_key(str(client.base_url), model, prompt, **({"variant": variant} if variant else {}))
+
+    def fetch():
+        lyrics = None if force_regenerate else response_cache.get(cache_key)
+        cleaned = None
+        if lyrics is None:
+            if stream:
+                # 边接收边清洗，写完最后一个段落即停止
+                lyrics, cleaned = stream_lyrics(client, model, prompt, sections, priority)
+            else:
+                completion = chat_completion(
+                    client,
+                    priority=priority,
+                    model=model,
+                    messages=[{"role": "user", "content": prompt}]
+                )
+                # Get the answer from the chat completion
+                lyrics = completion.choices[0].message.content
+            if lyrics:
+                response_cache.put(cache_key, lyrics)
+        if lyrics:
+            return cleaned or clean_generated_lyrics(lyrics)
+        return lyrics
+
+    # 同时发出的相同请求只调用一次模型，其余的等待同一个结果
+    return single_flight.do((cache_key, force_regenerate), fetch)
+# 歌曲特征字段，按输出顺序
+ANALYSIS_KEYS = ["emotion", "genre", "instrumentation", "timbre", "gender_suggestion"]
+def analysis_fields(indent, keys=ANALYSIS_KEYS):
+    """特征字段的JSON格式说明，列出每个字段的可选值，keys为要列出的字段"""
+    fields = {
+        "emotion": f'"emotion": "从{sorted(EMOTIONS)}中选择"',
+        "genre": f'"genre": "从{sorted(GENRES)}中选择1-2种"',
+        "instrumentation": f'"instrumentation": "从{sorted(INSTRUMENTATIONS)}中选择"',
+        "timbre": f'"timbre": "从{sorted(TIMBRES)}中选择"',
+        "gender_suggestion": f'"gender_suggestion": "从{sorted(SINGER_GENDERS)}中选择"',
+    }
+    return ",\n".join(" " * indent + fields[key] for key in keys)
+# 本地特征分析，索引在导入时建立一次
+lyrics_analyzer = LyricsAnalyzer(EMOTIONS, GENRES, INSTRUMENTATIONS, TIMBRES, SINGER_GENDERS)
+def parse_json_response(content: str):
+    """解析模型返回的JSON，去掉可能的代码块标记"""
+    # 预处理API响应
+    cleaned_result = content.strip()
+
+    # 处理可能的代码块标记
+    if cleaned_result.startswith("```json"):
+        cleaned_result = cleaned_result[7:].strip()
+    if cleaned_result.endswith("```"):
+        cleaned_result = cleaned_result[:-3].strip()
+
+    # 解析JSON
+    return json.loads(cleaned_result)
+def format_analysis(analysis: Dict[str, Any]) -> str:
+    """校验特征字段，无效值只打印提示，返回逗号分隔的特征"""
+    # 验证结果
+    if not all(key in analysis for key in ANALYSIS_KEYS):
+        print(f"缺少必要字段，应有: {ANALYSIS_KEYS}")
+
+    # 验证字段值有效性
+    if analysis["emotion"] not in EMOTIONS:
+        print(f"无效情绪: {analysis['emotion']}，应为: {EMOTIONS}")
+
+    if not any(g in analysis["genre"] for g in GENRES):
+        print(f"无效类型: {analysis['genre']}，应为: {GENRES}")
+
+    if analysis["instrumentation"] not in INSTRUMENTATIONS:
+        print(f"无效乐器组合: {analysis['instrumentation']}，应为: {INSTRUMENTATIONS}")
+
+    if analysis["timbre"] not in TIMBRES:
+        print(f"无效音色: {analysis['timbre']}，应为: {TIMBRES}")
+
+    if analysis["gender_suggestion"] not in SINGER_GENDERS:
+        print(f"无效性别建议: {analysis['gender_suggestion']}，应为: {SINGER_GENDERS}")
+
+    # 1-2种类型可能以列表返回
+    genre = analysis["genre"]
+    if isinstance(genre, list):
+        genre = ", ".join(genre)
+    # 返回验证通过的结果
+    return ", ".join([analysis["emotion"], genre, analysis["instrumentation"], analysis["timbre"],
+                      analysis["gender_suggestion"]])
+def request_completion(client, model, prompt, parse=None, force_regenerate=False, priority="interactive", **params):
+    """
+    Completion of prompt through the response cache, params are sent with the request and are part
+    of its cache key. parse(content) runs before the content is cached, a response it rejects by
+    raising is never stored. Returns the parsed content.
+    """
+    cache_key = response_key(str(client.base_url), model, prompt, **params)
+    parse = parse or (lambda content: content)
+
+    def fetch():
+        content = None if force_regenerate else response_cache.get(cache_key)
+        if content is not None:
+            return parse(content)
+        completion = chat_completion(
+            client,
+            priority=priority,
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            **params
+        )
+        content = completion.choices[0].message.content
+        result = parse(content)
+        response_cache.put(cache_key, content)
+        return result
+
+    return single_flight.do((cache_key, force_regenerate), fetch)
+def generate_lyrics_and_tags_prompt(lyric_prompt: str, template: Dict[str, Any], song_length: str) -> Optional[str]:
+    """歌词和歌曲特征一次生成的提示词，要求模型返回JSON"""
+    prompt = generate_lyrics_with_duration(lyric_prompt, template, song_length)
+    if prompt is None:
+        return None
+    return f"""{prompt}
+
+以JSON格式同时返回歌词和歌曲特征：
+{{
+    "lyrics": "完整歌词，格式同上面的返回格式示例，段落标签和每行歌词各占一行，用\\n换行",
+{analysis_fields(4)}
+}}
+注意：
+1. 必须返回合法JSON
+2. 特征值必须来自给定选项
+3. 不要包含任何额外文字"""
 
 
 
@@ -638,131 +855,135 @@ class gen_lyrics:
                     "round": 0.001,  # 精度
                     "display": "slider"}),  # 滑动调整           
             },
+            "optional": {
+                "force_regenerate": ("BOOLEAN", {"default": False,
+                                                 "tooltip": "Skip the response cache and ask the model again, the new "
+                                                            "lyrics replace the cached ones"}),
+                "stream": ("BOOLEAN", {"default": False,
+                                       "tooltip": "Stream the completion, report progress per section and stop "
+                                                  "once the last section of the structure is written"}),
+                "priority": (PRIORITIES, {"default": "interactive",
+                                          "tooltip": "With a rate limit set in config.json, batch requests wait "
+                                                     "while interactive ones are queued"}),
+            },
         }
 
+    @classmethod
+    def IS_CHANGED(cls, force_regenerate=False, **kwargs):
+        # with force_regenerate every queued run calls the model, not just the first one
+        return float("nan") if force_regenerate else ""
+
     OUTPUT_NODE = True
     RETURN_TYPES = ("STRING",)
     RETURN_NAMES = ("lyric",)  # 定义该节点返回的是歌词 字符串
     FUNCTION = "gen_lyrics"  # 定义节点的函数名字
     CATEGORY = "aimusic/gen-lyrics"  # 定义节点类别
-    def gen_lyrics(self, client,model, Lyric_theme, Lyric_structure, time_m, time_s):
-        song_length = f"{time_m}分{time_s}秒"
-        # 中文结构名到英文键的映射
-        structure_name_map = {
-            "流行基础结构": "pop_basic",
-            "流行带桥段结构": "pop_with_bridge",
-            "流行带预副歌结构": "pop_with_prechorus",
-            "流行双副歌结构": "pop_doublechorus",
-            "流行带后副歌结构": "pop_postchorus",
-            "中国民谣结构": "chinese_folk",
-            "戏曲结构": "chinese_opera",
-            "古琴曲结构": "guqin",
-            "民族融合结构": "ethnic_fusion",
-            "中国流行结构": "chinese_pop",
-            "蒙古呼麦结构": "mongolian_throat",
-            "经典摇滚结构": "rock_classic",
-            "前卫金属结构": "metal_progressive",
-            "朋克结构": "punk",
-            "硬摇滚结构": "hardrock",
-            "摇滚抒情曲结构": "rock_ballad",
-            "金属核结构": "metalcore",
-            "蓝调摇滚结构": "blues_rock",
-            "摇滚器乐曲结构": "rock_instrumental",
-            "EDM构建-高潮结构": "edm_builddrop",
-            "浩室结构": "house",
-            "回响贝斯结构": "dubstep",
-            "科技结构": "techno",
-            "鼓打贝斯结构": "drum_bass",
-            "氛围结构": "ambient",
-            "经典嘻哈结构": "hiphop_classic",
-            "陷阱结构": "trap",
-            "叙事说唱结构": "rap_storytelling",
-            "爵士嘻哈结构": "hiphop_jazzy",
-            "对战说唱结构": "rap_battle",
-            "爵士标准结构": "jazz_standard",
-            "12小节蓝调结构": "blues_12bar",
-            "爵士融合结构": "jazz_fusion",
-            "比博普结构": "bebop",
-            "爵士抒情曲结构": "jazz_ballad",
-        }
-        key = structure_name_map.get(Lyric_structure)
-        if key is None:
-            raise ValueError(f"未知的歌词结构: {Lyric_structure}")
-        template = STRUCTURE_TEMPLATES[key]
-        """生成带时长控制的歌词"""
+    def gen_lyrics(self, client,model, Lyric_theme, Lyric_structure, time_m, time_s, force_regenerate=False,
+                   stream=False, priority="interactive"):
+        template = get_structure_template(Lyric_structure)
+        prompt = generate_lyrics_with_duration(Lyric_theme, template, f"{time_m}分{time_s}秒")
+        if prompt is None:
+            return None
         try:
-            # 解析总时长
-            total_seconds = parse_duration_to_seconds(song_length)
-
-            # 计算段落时长
-            section_timings = calculate_section_timings(template["sections"], total_seconds)
-
-            # 构建提示词
-            prompt_lines = [
-                f"请根据以下要求生成一首中文歌曲的完整歌词：\n"
-                f"主题：{Lyric_theme}",
-                f"""歌曲结构：
-                    {", ".join([f"[{section}]" for section in template["sections"]])}
-                    具体要求：
-                    1. 严格按照给定的结构标签分段
-                    2. 器乐段落([intro-*]/[outro-*])不需要填歌词
-                    3. 人声段落([verse]/[chorus]/[bridge])必须包含歌词
-                    4. 主歌([verse])每段4-8行
-                    5. 副歌([chorus])要突出高潮部分
-                    6. 桥段([bridge])2-4行
-                    7. 整体要有押韵和节奏感
-                    8. 不要包含歌曲标题
-                    9. 不要包含韵脚分析等额外说明
-                    返回格式示例：
-                    [intro-medium]
-                    [verse]
-                    第一行歌词
-                    第二行歌词
-                    ...
-                    [chorus]
-                    副歌第一行
-                    副歌第二行
-                    ...""",
-                f"总时长：{song_length} ({total_seconds}秒)",
-                "段落时长分配："
-            ]
-
-            # 添加各段落信息
-            for section in template["sections"]:
-                desc = MUSIC_SECTION_TEMPLATES[section]["description"]
-                prompt_lines.append(f"- [{section}]: {section_timings[section]}秒 ({desc})")
-            # 添加歌词行数要求
-            prompt_lines.append("\n歌词要求：")
-            prompt_lines.append(f"1. 主歌([verse]): 每段{calc_lines_from_seconds(section_timings['verse'])}行")
-            prompt_lines.append(f"2. 副歌([chorus]): 每段{calc_lines_from_seconds(section_timings['chorus'])}行")
-            # 只有模板包含bridge时才添加bridge要求
-            if "bridge" in template["sections"]:
-                prompt_lines.append(f"3. 桥段([bridge]): {calc_lines_from_seconds(section_timings['bridge'])}行")
-
-            prompt_lines.append("4. 器乐段落不需要歌词")
-            prompt_lines.append("5. 注意押韵和节奏")
-            prompt = "\n".join(prompt_lines)
-            client = client["client"]
-            try:
-                completion = client.chat.completions.create(
-                    model=model,
-                    messages=[{"role": "user", "content": prompt}]
-                )
-            except:  # sometimes it fails first time to connect to server
-                completion = client.chat.completions.create(
-                    model=model,
-                    messages=[{"role": "user", "content": prompt}]
-                )
-            # Get the answer from the chat completion
-            lyrics = completion.choices[0].message.content
+            lyrics = request_lyrics(resolve_client(client), model, prompt, template["sections"],
+                                    force_regenerate=force_regenerate, stream=stream, priority=priority)
             if lyrics:
-                lyrics = clean_generated_lyrics(lyrics)
                 print(lyrics)
                 return (lyrics,)
         except Exception as e:
             print(f"歌词生成失败: {str(e)}")
             return None
 
+class gen_lyrics_batch(gen_lyrics):
+    """
+    一次生成多个歌词候选，并发请求
+    """
+    @classmethod
+    def INPUT_TYPES(s):
+        types = super().INPUT_TYPES()
+        types["required"]["num_variants"] = ("INT", {"default": 4, "min": 1, "max": 16, "step": 1})
+        types["optional"] = {
+            "force_regenerate": types["optional"]["force_regenerate"],
+            "max_concurrency": ("INT", {"default": 4, "min": 1, "max": 16, "step": 1,
+                                        "tooltip": "Requests sent at the same time"}),
+            "priority": (PRIORITIES, {"default": "batch", "tooltip": types["optional"]["priority"][1]["tooltip"]}),
+        }
+        return types
+
+    RETURN_NAMES = ("lyrics",)
+    OUTPUT_IS_LIST = (True,)  # 去重后的所有候选
+    FUNCTION = "gen_lyrics_batch"
+    def gen_lyrics_batch(self, client, model, Lyric_theme, Lyric_structure, time_m, time_s, num_variants,
+                         force_regenerate=False, max_concurrency=4, priority="batch"):
+        from comfy.utils import ProgressBar
+
+        template = get_structure_template(Lyric_structure)
+        prompt = generate_lyrics_with_duration(Lyric_theme, template, f"{time_m}分{time_s}秒")
+        if prompt is None:
+            return None
+        client = resolve_client(client)
+        pbar = ProgressBar(num_variants)
+
+        def run(variant):
+            try:
+                return request_lyrics(client, model, prompt, template["sections"], variant=variant,
+                                      force_regenerate=force_regenerate, priority=priority)
+            except Exception as e:
+                print(f"歌词生成失败: {str(e)}")
+                return None
+            finally:
+                pbar.update(1)
+
+        with ThreadPoolExecutor(max_workers=min(num_variants, max_concurrency),
+                                thread_name_prefix="gen_lyrics") as pool:
+            results = list(pool.map(run, range(num_variants)))
+        # 去掉失败和重复的结果，保持顺序
+        variants = list(dict.fromkeys(lyrics for lyrics in results if lyrics))
+        for lyrics in variants:
+            print(lyrics)
+        return (variants,)
+
+class gen_lyrics_and_tags(gen_lyrics):
+    """
+    一次请求同时生成歌词和歌曲特征，代替 gen_lyrics 加 analyze_lyrics 两次请求
+    """
+    @classmethod
+    def INPUT_TYPES(s):
+        types = super().INPUT_TYPES()
+        del types["optional"]["stream"]
+        types["optional"]["json_mode"] = ("BOOLEAN", {"default": True,
+                                                      "tooltip": "Ask for a JSON object with response_format, turn "
+                                                                 "off for endpoints that don't support it"})
+        return types
+
+    RETURN_TYPES = ("STRING", "STRING",)
+    RETURN_NAMES = ("lyric", "tags",)  # tags 与 analyze_lyrics 的输出格式相同
+    FUNCTION = "gen_lyrics_and_tags"
+    def gen_lyrics_and_tags(self, client, model, Lyric_theme, Lyric_structure, time_m, time_s,
+                            force_regenerate=False, priority="interactive", json_mode=True):
+        template = get_structure_template(Lyric_structure)
+        prompt = generate_lyrics_and_tags_prompt(Lyric_theme, template, f"{time_m}分{time_s}秒")
+        if prompt is None:
+            return None
+
+        def parse(content):
+            result = parse_json_response(content)
+            lyrics = result.get("lyrics") if isinstance(result, dict) else None
+            if isinstance(lyrics, list):
+                lyrics = "\n".join(lyrics)
+            if not lyrics or not all(key in result for key in ANALYSIS_KEYS):
+                raise ValueError(f"响应缺少歌词或特征字段: {content[:200]}")
+            return dict(result, lyrics=lyrics)
+
+        params = {"response_format": {"type": "json_object"}} if json_mode else {}
+        result = request_completion(resolve_client(client), model, prompt, parse=parse,
+                                    force_regenerate=force_regenerate, priority=priority, **params)
+        lyrics = clean_generated_lyrics(result["lyrics"])
+        tags = format_analysis(result)
+        print(lyrics)
+        print(tags)
+        return (lyrics, tags,)
+
 class load_openAI:
     """
     this node will load  openAI model
@@ -773,7 +994,8 @@ class load_openAI:
         return {
             "required": {
                 "base_url": ("STRING", {"multiline": False, "default": "https://openai-cf.realnow.workers.dev/v1"}),
-                "api_key": ("STRING", {"multiline": False, "default": ""}),
+                "api_key": ("STRING", {"multiline": False, "default": "",
+                                       "tooltip": "Empty uses openAI_API_Key from config.json"}),
             }
         }
 
@@ -783,19 +1005,18 @@ class load_openAI:
     CATEGORY = "aimusic/openai"  # Define the category for the node
 
     def fun(self,base_url,api_key):
-        install_openai()  # Install the OpenAI module if not already installed
-        from openai import OpenAI
-        # Get the API key from the file
-        # api_key = api_key#get_api_key()
-        client = OpenAI(
-                    # This is the default and can be omitted
-                    api_key=api_key,
-                    base_url=base_url
-                )
+        # an empty api_key falls back to openAI_API_Key from config.json
+        api_key = api_key or get_api_key()
+        # shared per (base_url, api_key), re-executions reuse its connection pool
+        client = get_client(base_url, api_key)
+        refresh_models_async(client, base_url)
         
         return (
             {
                 "client": client,  # Return openAI model
+                # gen_lyrics/analyze_lyrics look the client up again, it is rebuilt if closed while idle
+                "base_url": base_url,
+                "api_key": api_key,
             },
         )
 
@@ -811,6 +1032,9 @@ class analyze_lyrics:
                 "client": ("CLIENT",),
                 "model": (get_gpt_models(), {"default": "gpt-3.5-turbo"}),
                 "lyrics": ("STRING", {"multiline": True, "default": "你好"}),
+            },
+            "optional": {
+                "priority": (PRIORITIES, {"default": "interactive"}),
             }
         }
     # Define the return type of the node
@@ -819,73 +1043,49 @@ class analyze_lyrics:
     FUNCTION = "fun"  # Define the function name for the node
     # Define the category for the node
     CATEGORY = "aimusic/openai"
-    def fun(self,client, model, lyrics):
+    def fun(self,client, model, lyrics, priority="interactive"):
+        # 先在本地分析，只有置信度低于阈值的特征才请求模型
+        local = lyrics_analyzer.analyze(lyrics)
+        analysis = {key: label for key, (label, _) in local.items()}
+        threshold = config.get("lyrics_analyzer_threshold")
+        thresholds = config.get("lyrics_analyzer_thresholds")
+        uncertain = [key for key in ANALYSIS_KEYS if local[key][1] < thresholds.get(key, threshold)]
+        print("本地分析: " + ", ".join(f"{key}={label}({confidence:.2f})" for key, (label, confidence) in local.items()))
+        if not uncertain:
+            result = format_analysis(analysis)
+            print(result)
+            return (result,)
+
         prompt = f"""请严格按以下JSON格式分析歌词特征：
         {lyrics}
         返回格式必须为：
         {{
-            "emotion": "从{sorted(EMOTIONS)}中选择",
-            "genre": "从{sorted(GENRES)}中选择1-2种",
-            "instrumentation": "从{sorted(INSTRUMENTATIONS)}中选择",
-            "timbre": "从{sorted(TIMBRES)}中选择",
-            "gender_suggestion": "从{sorted(SINGER_GENDERS)}中选择"
+{analysis_fields(12, uncertain)}
         }}
         注意：
         1. 必须返回合法JSON
         2. 所有值必须来自给定选项
         3. 不要包含任何额外文字"""
         # Create a chat completion using the OpenAI module
-        client = client["client"]
+        client = resolve_client(client)
 
-        try:
-            completion = client.chat.completions.create(
+        def fetch():
+            completion = chat_completion(
+                client,
+                priority=priority,
                 model=model,
                 messages=[{"role": "user", "content": prompt}]
             )
-        except:  # sometimes it fails first time to connect to server
-            completion = client.chat.completions.create(
-                model=model,
-                messages=[{"role": "user", "content": prompt}]
-            )
-        # Get the answer from the chat completion
-        content = completion.choices[0].message.content
-        # 预处理API响应
-        cleaned_result = content.strip()
-
-        # 处理可能的代码块标记
-        if cleaned_result.startswith("```json"):
-            cleaned_result = cleaned_result[7:].strip()
-        if cleaned_result.endswith("```"):
-            cleaned_result = cleaned_result[:-3].strip()
-
-        # 解析JSON
-        analysis = json.loads(cleaned_result)
-
-        # 验证结果
-        required_keys = ["emotion", "genre", "instrumentation",
-                         "timbre", "gender_suggestion"]
-        if not all(key in analysis for key in required_keys):
-            print(f"缺少必要字段，应有: {required_keys}")
-
-        # 验证字段值有效性
-        if analysis["emotion"] not in EMOTIONS:
-            print(f"无效情绪: {analysis['emotion']}，应为: {EMOTIONS}")
-
-        if not any(g in analysis["genre"] for g in GENRES):
-            print(f"无效类型: {analysis['genre']}，应为: {GENRES}")
-
-        if analysis["instrumentation"] not in INSTRUMENTATIONS:
-            print(f"无效乐器组合: {analysis['instrumentation']}，应为: {INSTRUMENTATIONS}")
-
-        if analysis["timbre"] not in TIMBRES:
-            print(f"无效音色: {analysis['timbre']}，应为: {TIMBRES}")
-
-        if analysis["gender_suggestion"] not in SINGER_GENDERS:
-            print(f"无效性别建议: {analysis['gender_suggestion']}，应为: {SINGER_GENDERS}")
-
-        # 返回验证通过的结果
-        result = ", ".join([analysis["emotion"], analysis["genre"], analysis["instrumentation"], analysis["timbre"],
-                   analysis["gender_suggestion"]])
+            # Get the answer from the chat completion
+            return completion.choices[0].message.content
+        # 多个分支同时分析同一段歌词时只请求一次
+        content = single_flight.do(response_key(str(client.base_url), model, prompt), fetch)
+        answer = parse_json_response(content)
+        missing = [key for key in uncertain if key not in answer]
+        if missing:
+            print(f"模型未返回 {missing}，使用本地分析结果")
+        analysis.update({key: answer[key] for key in uncertain if key in answer})
+        result = format_analysis(analysis)
         print(result)
         return (result,)
 
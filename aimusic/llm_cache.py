@@ -0,0 +1,104 @@
+"""
+Persistent cache of LLM responses, shared by all ComfyUI processes of this plugin.
+
+Responses live in a SQLite database next to the plugin (llm_cache.sqlite3, WAL mode so several
+processes can read and write it at once), keyed by a hash of base_url, model, prompt and the
+sampling parameters. The raw completion text is stored, cleaning runs again on every hit.
+Entries older than llm_cache_max_age seconds are dropped and the least recently used ones are
+evicted once the stored responses exceed llm_cache_mb.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from . import config
+
+LLM_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "llm_cache.sqlite3")
+
+
+def response_key(base_url, model, prompt, **params):
+    """Cache key of a completion request, params are the sampling parameters sent with it"""
+    request = {"base_url": base_url or "", "model": model, "prompt": prompt, "params": params}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path):
+        self.path = path
+        # sqlite3 connections can't be shared between threads
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # autocommit, writes take the write lock up front with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with self._init_lock:
+                # the schema is set up once per process, concurrent DDL would serialize every thread
+                if not self._initialized:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+                                 "response TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, "
+                                 "accessed REAL NOT NULL)")
+                    conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+                    self._initialized = True
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        """The cached response of key or None, a cache that can't be read counts as a miss"""
+        now = time.time()
+        try:
+            conn = self._connect()
+            row = conn.execute("SELECT response FROM responses WHERE key = ? AND created >= ?",
+                               (key, now - config.get("llm_cache_max_age"))).fetchone()
+            if row is not None:
+                conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        except sqlite3.Error as e:
+            print(f"Error: could not read the LLM response cache: {e}")
+            return None
+        return None if row is None else row[0]
+
+    def put(self, key, response):
+        now = time.time()
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                             (key, response, len(response.encode()), now, now))
+                self._evict(conn, now)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            print(f"Error: could not write the LLM response cache: {e}")
+
+    def clear(self):
+        self._connect().execute("DELETE FROM responses")
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM responses WHERE created < ?", (now - config.get("llm_cache_max_age"),))
+        max_bytes = int(config.get("llm_cache_mb") * 1024 * 1024)
+        nbytes = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if nbytes <= max_bytes:
+            return
+        # least recently used first, until the rest fits
+        evicted = []
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            if nbytes <= max_bytes:
+                break
+            evicted.append((key,))
+            nbytes -= size
+        conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+
+# raw completions of gen_lyrics
+response_cache = ResponseCache(LLM_CACHE_PATH)
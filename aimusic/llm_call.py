@@ -0,0 +1,211 @@
+"""
+Shared call path of the LLM nodes: chat completions with a deadline, retries and a circuit breaker
+per endpoint.
+
+Timeouts, connection errors, 408/409/429 and 5xx answers are retried with exponential backoff and
+full jitter, or after the delay the server asks for with Retry-After. Retries are limited per call
+(llm_max_attempts), by the call's deadline (llm_deadline) and by a retry budget per endpoint: within
+a minute at most llm_retry_budget_min plus llm_retry_budget_ratio of the calls may be retried, so a
+struggling endpoint doesn't get several times its normal load. After llm_breaker_failures failed
+calls in a row the endpoint's breaker opens and calls fail at once with CircuitOpenError for
+llm_breaker_cooldown seconds, then a single probe call decides whether it closes again.
+
+single_flight coalesces identical requests made at the same time within the process.
+"""
+import collections
+import email.utils
+import random
+import threading
+import time
+
+from . import config
+from .llm_client import import_openai
+from .llm_ratelimit import estimate_tokens, rate_limiter
+
+_RETRY_STATUS = {408, 409, 429}
+_BUDGET_WINDOW = 60.0
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class _Endpoint:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = collections.deque()
+        self.retries = collections.deque()
+        self.failures = 0  # failed calls in a row
+        self.open_until = 0.0
+        self.probing = False
+
+    def _trim(self, now):
+        for times in (self.calls, self.retries):
+            while times and now - times[0] > _BUDGET_WINDOW:
+                times.popleft()
+
+    def acquire(self, endpoint):
+        """Admit a call, or raise CircuitOpenError while the breaker is open"""
+        now = time.monotonic()
+        with self.lock:
+            if self.failures >= config.get("llm_breaker_failures"):
+                if now < self.open_until or self.probing:
+                    wait = max(self.open_until - now, 0.0)
+                    raise CircuitOpenError(f"{endpoint} failed {self.failures} times in a row, not calling it "
+                                           f"for another {wait:.0f}s")
+                # half open: this call probes the endpoint, the others keep failing fast
+                self.probing = True
+            self._trim(now)
+            self.calls.append(now)
+
+    def allow_retry(self):
+        now = time.monotonic()
+        with self.lock:
+            self._trim(now)
+            budget = config.get("llm_retry_budget_min") + config.get("llm_retry_budget_ratio") * len(self.calls)
+            if len(self.retries) >= budget:
+                return False
+            self.retries.append(now)
+            return True
+
+    def release(self, ok):
+        with self.lock:
+            self.probing = False
+            if ok:
+                self.failures = 0
+            else:
+                self.failures += 1
+                if self.failures >= config.get("llm_breaker_failures"):
+                    self.open_until = time.monotonic() + config.get("llm_breaker_cooldown")
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    do(key, fn) runs fn once for all callers that ask for the same key while it runs, they all get
+    its result or its exception. Nothing is kept once it returns, caching is up to fn.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+
+_lock = threading.Lock()
+_endpoints = {}
+
+
+def _endpoint(name):
+    with _lock:
+        return _endpoints.setdefault(name, _Endpoint())
+
+
+def _retryable(openai, error):
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and (error.status_code in _RETRY_STATUS or
+                                                        error.status_code >= 500)
+
+
+def _retry_after(error):
+    """Delay in seconds the server asked for, or None"""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            value = headers["retry-after"]
+            try:
+                return float(value)
+            except ValueError:
+                return email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def chat_completion(client, deadline=None, priority="interactive", **kwargs):
+    """
+    client.chat.completions.create(**kwargs) with retries. deadline is the time.monotonic() by
+    which the call has to finish, llm_deadline seconds from now by default. With stream=True the
+    retries cover the call until the response starts, the returned stream isn't retried.
+    Every attempt waits for the rate limiter of the endpoint first, with the given priority.
+    """
+    openai = import_openai()
+    endpoint = str(client.base_url)
+    state = _endpoint(endpoint)
+    if deadline is None:
+        deadline = time.monotonic() + config.get("llm_deadline")
+    # the retries happen here, not inside the client
+    client = client.with_options(max_retries=0)
+    tokens = estimate_tokens(kwargs.get("messages", ()), kwargs.get("max_tokens"))
+    attempt = 0
+    error = None
+    while True:
+        rate_limiter.acquire(endpoint, tokens, priority, deadline)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise error or TimeoutError(f"deadline of the call to {endpoint} passed before it was sent")
+        state.acquire(endpoint)
+        try:
+            result = client.chat.completions.create(timeout=min(config.get("llm_timeout"), remaining), **kwargs)
+        except Exception as e:
+            error = e
+            if not _retryable(openai, e):
+                # retrying can't fix it, and it doesn't say the endpoint is down
+                state.release(True)
+                raise
+            state.release(False)
+            if isinstance(e, openai.RateLimitError):
+                rate_limiter.throttled(endpoint)
+        else:
+            state.release(True)
+            # streams report no usage, their estimate stands
+            usage = getattr(result, "usage", None)
+            rate_limiter.settle(endpoint, tokens, usage.total_tokens if usage else None)
+            return result
+        attempt += 1
+        if attempt >= config.get("llm_max_attempts") or not state.allow_retry():
+            raise error
+        delay = _retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(config.get("llm_backoff_max"),
+                                          config.get("llm_backoff_base") * 2 ** (attempt - 1)))
+        if time.monotonic() + delay >= deadline:
+            raise error
+        print(f"LLM call to {endpoint} failed ({error}), retrying in {delay:.1f}s")
+        time.sleep(max(delay, 0.0))
+
+
+# keyed by the response cache key of the request: endpoint, model, prompt hash
+single_flight = SingleFlight()
@@ -0,0 +1,90 @@
+"""
+Process-wide registry of OpenAI clients for the LLM nodes, one per (base_url, api_key hash).
+
+Every client owns one keep-alive httpx connection pool, so back-to-back calls to the same endpoint
+skip the TCP/TLS setup. Pool size and timeouts come from config.json (llm_max_connections,
+llm_timeout, llm_connect_timeout, llm_keepalive_expiry). Clients unused for llm_client_idle_timeout
+seconds are closed the next time the registry is accessed; CLIENT inputs resolve through the
+registry again, so a closed client is rebuilt transparently.
+"""
+import atexit
+import hashlib
+import importlib
+import sys
+import threading
+import time
+
+from . import config
+
+_lock = threading.Lock()
+# client_key -> [client, last used]
+_clients = {}
+
+
+def import_openai():
+    # openai is only imported once an LLM node runs, and never installed at runtime
+    try:
+        return importlib.import_module('openai')
+    except ImportError:
+        raise ImportError("The aimusic LLM nodes need the openai package, install it into the ComfyUI "
+                          "environment with: pip install openai") from None
+
+
+def client_key(base_url, api_key):
+    """Registry key of an endpoint, the api key only enters it hashed"""
+    return base_url or "", hashlib.sha256((api_key or "").encode()).hexdigest()[:16]
+
+
+def _new_client(base_url, api_key):
+    openai = import_openai()
+    # the http library of this openai release, httpx or httpx2 for the 3.x releases
+    httpx = sys.modules[openai.DefaultHttpxClient.__mro__[1].__module__.split(".")[0]]
+
+    timeout = httpx.Timeout(config.get("llm_timeout"), connect=config.get("llm_connect_timeout"))
+    max_connections = config.get("llm_max_connections")
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                          keepalive_expiry=config.get("llm_keepalive_expiry"))
+    http_client = openai.DefaultHttpxClient(timeout=timeout, limits=limits)
+    return openai.OpenAI(api_key=api_key, base_url=base_url or None, timeout=timeout, http_client=http_client)
+
+
+def _close(clients):
+    for client in clients:
+        try:
+            client.close()
+        except Exception as e:
+            print(f"Error: could not close OpenAI client: {e}")
+
+
+def get_client(base_url, api_key):
+    """The shared client of base_url and api_key, created on first use"""
+    key = client_key(base_url, api_key)
+    now = time.monotonic()
+    idle_timeout = config.get("llm_client_idle_timeout")
+    with _lock:
+        idle = [k for k, (_, last_used) in _clients.items() if k != key and now - last_used > idle_timeout]
+        closing = [_clients.pop(k)[0] for k in idle]
+        entry = _clients.get(key)
+        if entry is None:
+            entry = _clients[key] = [_new_client(base_url, api_key), now]
+        entry[1] = now
+    _close(closing)
+    return entry[0]
+
+
+def resolve_client(client):
+    """The pooled OpenAI client behind a CLIENT input"""
+    if "base_url" in client and "api_key" in client:
+        return get_client(client["base_url"], client["api_key"])
+    # CLIENT dicts built by other nodes only carry the client
+    return client["client"]
+
+
+def close_all():
+    with _lock:
+        clients = [client for client, _ in _clients.values()]
+        _clients.clear()
+    _close(clients)
+
+
+atexit.register(close_all)
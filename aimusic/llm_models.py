@@ -0,0 +1,89 @@
+"""
+Model list discovery for the LLM nodes, kept off the ComfyUI startup path.
+
+INPUT_TYPES only reads the lists persisted on disk by earlier runs, per base_url. Refreshing
+them calls the endpoint in a background thread, started when a client is loaded and the
+cached list is older than the model_list_ttl setting.
+"""
+import json
+import os
+import threading
+import time
+
+from . import config
+
+MODEL_CACHE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "model_cache.json")
+
+_lock = threading.Lock()
+_refreshing = set()
+_cache = None
+
+
+def _load():
+    global _cache
+    if _cache is None:
+        try:
+            with open(MODEL_CACHE_PATH, "r", encoding="utf-8") as f:
+                _cache = json.load(f)
+        except (OSError, ValueError):
+            _cache = {}
+    return _cache
+
+
+def _save(cache):
+    tmp_path = f"{MODEL_CACHE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, MODEL_CACHE_PATH)
+
+
+def get_cached_models(fallback, base_url=None):
+    """fallback followed by the cached models of base_url, or of every endpoint seen so far"""
+    with _lock:
+        cache = _load()
+        entries = [cache[base_url]] if base_url in cache else ([] if base_url else list(cache.values()))
+    models = list(fallback)
+    for entry in entries:
+        models += [model for model in entry["models"] if model not in models]
+    return models
+
+
+def refresh_models(client, base_url):
+    """List the models of base_url now and persist them"""
+    try:
+        models = [model.id for model in client.models.list().data]
+    except Exception as e:
+        print(f"Error: could not list the models of {base_url}: {e}")
+        return None
+    global _cache
+    with _lock:
+        # re-read first, other ComfyUI processes may have refreshed other endpoints
+        _cache = None
+        cache = _load()
+        cache[base_url] = {"models": models, "updated": time.time()}
+        try:
+            _save(cache)
+        except OSError as e:
+            print(f"Error: could not save the model list cache: {e}")
+    return models
+
+
+def refresh_models_async(client, base_url, ttl=None):
+    """Refresh the model list of base_url in a background thread when it is missing or older than ttl"""
+    ttl = config.get("model_list_ttl") if ttl is None else ttl
+    with _lock:
+        entry = _load().get(base_url)
+        if base_url in _refreshing or (entry is not None and time.time() - entry["updated"] < ttl):
+            return None
+        _refreshing.add(base_url)
+
+    def run():
+        try:
+            refresh_models(client, base_url)
+        finally:
+            with _lock:
+                _refreshing.discard(base_url)
+
+    thread = threading.Thread(target=run, name="aimusic-model-list", daemon=True)
+    thread.start()
+    return thread
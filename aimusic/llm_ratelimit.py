@@ -0,0 +1,163 @@
+"""
+Client-side rate limiting of the LLM endpoints, shared by all ComfyUI processes of this plugin.
+
+Every endpoint has a token bucket for requests per minute and one for tokens per minute, refilled
+continuously, in a SQLite database next to the plugin (llm_ratelimit.sqlite3). Limits come from
+config.json: llm_rpm/llm_tpm for all endpoints, llm_rate_limits for single ones, e.g.
+{"https://api.example.com/v1": {"rpm": 60, "tpm": 90000}}. 0 means unlimited, with no limits set
+nothing is read or written.
+
+Callers waiting for an interactive request register themselves, batch requests don't take from the
+buckets while one of those is waiting, in any process. Token counts are estimated from the prompt
+before the call and corrected with the usage the endpoint reports.
+"""
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from . import config
+
+LLM_RATELIMIT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                                  "llm_ratelimit.sqlite3")
+PRIORITIES = ["interactive", "batch"]
+# waiting callers poll the buckets at least this often, and count as gone after _WAITER_TTL seconds
+_POLL = 0.25
+_WAITER_TTL = 10.0
+
+
+def get_limits(endpoint):
+    """(rpm, tpm) of endpoint, 0 for unlimited"""
+    limits = {"rpm": config.get("llm_rpm"), "tpm": config.get("llm_tpm")}
+    for url, override in config.get("llm_rate_limits").items():
+        if url.rstrip("/") == endpoint.rstrip("/"):
+            limits.update(override)
+    return float(limits["rpm"] or 0), float(limits["tpm"] or 0)
+
+
+def estimate_tokens(messages, max_tokens=None):
+    """Upper estimate of the tokens of a chat completion, one per prompt character"""
+    prompt = sum(len(message.get("content") or "") for message in messages)
+    return prompt + (max_tokens or config.get("llm_completion_tokens"))
+
+
+class RateLimiter:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with self._init_lock:
+                if not self._initialized:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("CREATE TABLE IF NOT EXISTS buckets (endpoint TEXT PRIMARY KEY, "
+                                 "requests REAL NOT NULL, tokens REAL NOT NULL, updated REAL NOT NULL)")
+                    conn.execute("CREATE TABLE IF NOT EXISTS waiters (id TEXT PRIMARY KEY, endpoint TEXT NOT NULL, "
+                                 "priority INTEGER NOT NULL, seen REAL NOT NULL)")
+                    self._initialized = True
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self, conn, fn):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn()
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def _bucket(self, conn, endpoint, rpm, tpm, now):
+        """Refilled (requests, tokens) of endpoint, a new bucket starts full"""
+        row = conn.execute("SELECT requests, tokens, updated FROM buckets WHERE endpoint = ?", (endpoint,)).fetchone()
+        if row is None:
+            return rpm, tpm
+        requests, tokens, updated = row
+        elapsed = max(now - updated, 0.0)
+        return min(rpm, requests + elapsed * rpm / 60), min(tpm, tokens + elapsed * tpm / 60)
+
+    def acquire(self, endpoint, tokens, priority="interactive", deadline=None):
+        """
+        Take one request and tokens from the buckets of endpoint, waiting until they are available.
+        Raises TimeoutError when that would take past deadline (a time.monotonic() value).
+        """
+        rpm, tpm = get_limits(endpoint)
+        if not rpm and not tpm:
+            return
+        rank = PRIORITIES.index(priority)
+        # more than a full bucket would never be granted
+        tokens = min(tokens, tpm) if tpm else 0
+        waiter = uuid.uuid4().hex
+
+        def attempt():
+            now = time.time()
+            if rank > 0 and conn.execute("SELECT 1 FROM waiters WHERE endpoint = ? AND priority < ? AND seen > ?",
+                                         (endpoint, rank, now - _WAITER_TTL)).fetchone():
+                wait = _POLL
+            else:
+                requests, available = self._bucket(conn, endpoint, rpm or 1, tpm or 1, now)
+                wait = max((1 - requests) * 60 / rpm if rpm else 0, (tokens - available) * 60 / tpm if tpm else 0)
+                if wait <= 0:
+                    conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                                 (endpoint, requests - 1 if rpm else requests, available - tokens, now))
+                    conn.execute("DELETE FROM waiters WHERE id = ?", (waiter,))
+                    return 0
+            conn.execute("INSERT OR REPLACE INTO waiters VALUES (?, ?, ?, ?)", (waiter, endpoint, rank, now))
+            return wait
+
+        try:
+            conn = self._connect()
+            while True:
+                wait = self._transaction(conn, attempt)
+                if wait <= 0:
+                    return
+                if deadline is not None and time.monotonic() + wait > deadline:
+                    raise TimeoutError(f"rate limit of {endpoint} allows the call only in {wait:.1f}s, "
+                                       f"after its deadline")
+                time.sleep(min(wait, _POLL))
+        except sqlite3.Error as e:
+            # an unusable database doesn't block the call, it only goes unlimited
+            print(f"Error: LLM rate limiter unavailable, calling {endpoint} without it: {e}")
+        except BaseException:
+            conn.execute("DELETE FROM waiters WHERE id = ?", (waiter,))
+            raise
+
+    def settle(self, endpoint, estimated, used):
+        """Correct the token bucket of endpoint once the tokens a call used are known"""
+        rpm, tpm = get_limits(endpoint)
+        if not tpm or used is None:
+            return
+        try:
+            self._connect().execute("UPDATE buckets SET tokens = MIN(?, tokens + ?) WHERE endpoint = ?",
+                                    (tpm, min(estimated, tpm) - used, endpoint))
+        except sqlite3.Error as e:
+            print(f"Error: could not update the LLM rate limiter: {e}")
+
+    def throttled(self, endpoint):
+        """The endpoint answered 429: empty its buckets so every process backs off"""
+        rpm, tpm = get_limits(endpoint)
+        if not rpm and not tpm:
+            return
+
+        def drain():
+            now = time.time()
+            requests, available = self._bucket(conn, endpoint, rpm or 1, tpm or 1, now)
+            conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                         (endpoint, min(requests, 0.0), min(available, 0.0) if tpm else available, now))
+
+        try:
+            conn = self._connect()
+            self._transaction(conn, drain)
+        except sqlite3.Error as e:
+            print(f"Error: could not update the LLM rate limiter: {e}")
+
+
+rate_limiter = RateLimiter(LLM_RATELIMIT_PATH)
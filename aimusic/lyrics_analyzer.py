@@ -0,0 +1,236 @@
+"""
+Local analysis of lyrics for analyze_lyrics, without network access.
+
+Every feature is scored by counting cue words in the lyrics: Chinese cues match as character
+n-grams, latin ones as whole words, and the English labels of the emotion and genre vocabularies
+and the instruments of the instrumentation labels are cues of themselves. The index is built once
+when the analyzer is created. Instrumentation and timbre also take the winning genre and emotion
+as evidence, since lyrics rarely name them, and the singer's gender the third persons and forms
+of address of the lyrics.
+
+The confidence of a feature is the score of its best label over all scores plus PRIOR, so it only
+gets high with several cues agreeing. Indirect evidence counts for less: without a cue of their own
+instrumentation and timbre get DERIVED_WEIGHT of the confidence of the genre or emotion they follow,
+and a gender only hinted at HINT_WEIGHT of its confidence. analyze_lyrics asks the LLM for the
+features whose confidence is below their threshold, see lyrics_analyzer_thresholds.
+"""
+import re
+
+# pseudo-count added to the total score, one cue alone gives a confidence of 1/3
+PRIOR = 2.0
+# repeated choruses count a cue at most this often
+MAX_HITS = 3
+# weight of a gender hint against a cue, self-references like 我是女孩 also contain one
+HINT_WEIGHT = 0.5
+# share of the genre or emotion confidence an instrumentation or timbre follows it with
+DERIVED_WEIGHT = 0.75
+
+# cue words per label, on top of the labels themselves
+EMOTION_CUES = {
+    "sad": ["泪", "哭", "伤心", "心碎", "难过", "离开", "分手", "再见", "失去", "痛", "tears", "cry", "goodbye",
+            "broken"],
+    "emotional": ["感动", "心跳", "真心", "感情", "情深", "heart", "feel"],
+    "angry": ["恨", "怒", "背叛", "谎言", "骗", "hate", "liar", "rage"],
+    "happy": ["快乐", "开心", "笑", "幸福", "甜", "阳光", "欢乐", "smile", "sunshine", "fun"],
+    "uplifting": ["梦想", "希望", "飞翔", "勇敢", "坚持", "未来", "出发", "相信", "追逐", "dream", "fly", "hope",
+                  "rise"],
+    "intense": ["燃烧", "战斗", "疯狂", "冲", "咆哮", "火焰", "极限", "fire", "fight", "wild"],
+    "romantic": ["爱你", "亲爱", "拥抱", "吻", "心动", "浪漫", "玫瑰", "牵手", "温柔", "love", "kiss", "darling"],
+    "melancholic": ["回忆", "思念", "寂寞", "孤单", "孤独", "落叶", "黄昏", "秋", "雨", "往事", "lonely", "memories",
+                    "rain"],
+}
+GENRE_CUES = {
+    "Chinese Tradition": ["江湖", "红尘", "明月", "长安", "天涯", "剑", "侠", "千年", "烟雨", "琵琶", "古筝", "胭脂",
+                          "青丝", "轮回", "故人", "桃花", "山河"],
+    "Chinese Opera": ["戏台", "戏曲", "唱戏", "梨园", "唱腔", "青衣", "花旦", "粉墨", "京剧", "昆曲"],
+    "Metal": ["金属", "地狱", "毁灭", "恶魔", "hell", "demon"],
+    "electronic": ["电音", "电子", "霓虹", "neon"],
+    "hip hop": ["嘻哈", "hiphop"],
+    "rap": ["说唱", "韵脚", "麦克风", "flow", "mic", "yo", "homie"],
+    "rock": ["摇滚", "呐喊", "嘶吼", "叛逆"],
+    "jazz": ["爵士", "威士忌", "whiskey"],
+    "blues": ["蓝调"],
+    "classical": ["古典", "交响"],
+    "country": ["乡村", "田野", "小镇", "公路", "牧场", "cowboy", "highway"],
+    "folk": ["民谣", "远方", "故乡", "流浪", "南方", "北方", "小酒馆"],
+    "soul": ["灵魂"],
+    "dance, pop": ["跳舞", "舞池", "派对", "蹦迪", "party", "dj", "dancing"],
+    "k-pop": ["欧巴", "oppa", "saranghae"],
+    "R&B": ["节奏布鲁斯", "rnb"],
+}
+INSTRUMENT_CUES = {
+    "piano": ["钢琴", "琴键"],
+    "guitar": ["吉他", "琴弦"],
+    "acoustic guitar": ["木吉他", "原声吉他"],
+    "electric guitar": ["电吉他"],
+    "drums": ["鼓声", "鼓点", "打鼓"],
+    "synthesizer": ["合成器", "synth"],
+    "strings": ["弦乐"],
+    "violin": ["小提琴"],
+    "fiddle": [],
+    "cello": ["大提琴"],
+    "double bass": ["低音提琴"],
+    "bass": ["贝斯"],
+    "saxophone": ["萨克斯", "sax"],
+    "trumpet": ["小号"],
+    "brass": ["铜管"],
+    "harmonica": ["口琴"],
+    "banjo": ["班卓琴"],
+    "beats": ["节拍", "beat"],
+}
+TIMBRE_CUES = {
+    "dark": ["黑暗", "深渊", "午夜", "darkness"],
+    "bright": ["明亮", "闪耀", "光芒", "shine", "bright"],
+    "warm": ["暖", "warm"],
+    "soft": ["轻轻", "轻柔", "低语", "soft", "whisper"],
+}
+# the singer speaking of themselves
+GENDER_CUES = {
+    "male": ["男儿", "我是男人", "你的男人", "小伙子", "your man", "i'm a man"],
+    "female": ["小女子", "我是女孩", "你的女人", "我是女人", "your girl", "i'm a girl", "your woman"],
+}
+# third persons and forms of address only hint at the singer, a love song can be sung by anyone
+GENDER_HINTS = {
+    "male": ["姑娘", "女孩", "妹妹", "她的", "想她", "爱她", "为她", "girl", "she", "her"],
+    "female": ["男孩", "哥哥", "情郎", "他的", "想他", "爱他", "为他", "boy", "he", "him", "his"],
+}
+# the usual arrangement of a genre and timbre of an emotion
+GENRE_INSTRUMENTATION = {
+    "pop": "synthesizer and piano", "electronic": "synthesizer", "hip hop": "beats", "rap": "beats",
+    "rock": "electric guitar and drums", "classic rock": "electric guitar and drums",
+    "hard rock": "electric guitar and drums", "Metal": "electric guitar and drums",
+    "pop punk": "electric guitar and drums", "rock and roll": "electric guitar and drums",
+    "rockabilly": "guitar and drums", "pop rock": "guitar and drums", "Reggae": "guitar and drums",
+    "reggae": "guitar and drums", "jazz": "piano and saxophone", "blues": "guitar and harmonica",
+    "classical": "piano and strings", "Chinese Tradition": "piano and strings",
+    "Chinese Opera": "piano and strings", "country": "guitar and fiddle",
+    "folk": "acoustic guitar and harmonica", "soul": "brass and piano", "R&B": "synthesizer and bass",
+    "dance, electronic": "synthesizer and drums", "dance, dancepop, house, pop": "synthesizer and drums",
+    "dance, pop": "synthesizer and drums", "dance, deephouse, electronic": "synthesizer and bass",
+    "k-pop": "synthesizer and drums", "experimental": "synthesizer", "experimental pop": "synthesizer and piano",
+}
+EMOTION_TIMBRE = {
+    "sad": "soft", "emotional": "vocal", "angry": "rock", "happy": "bright", "uplifting": "bright",
+    "intense": "rock", "romantic": "warm", "melancholic": "dark",
+}
+# labels that say nothing about lyrics and are never cues of themselves
+_PLACEHOLDERS = {"Auto", "varies"}
+
+_TAG = re.compile(r"\[[^\]]*\]")
+_CJK = re.compile(r"[一-鿿]+")
+_WORD = re.compile(r"[a-z&'-]+")
+
+
+class LyricsAnalyzer:
+    def __init__(self, emotions, genres, instrumentations, timbres, genders):
+        self.vocabularies = {"emotion": emotions, "genre": genres, "instrumentation": instrumentations,
+                             "timbre": timbres, "gender_suggestion": genders}
+        # cue -> [(feature, label)], Chinese cues by string and latin ones by word tuple
+        self._chars = {}
+        self._words = {}
+        for feature, cues in (("emotion", EMOTION_CUES), ("genre", GENRE_CUES), ("timbre", TIMBRE_CUES),
+                              ("gender_suggestion", GENDER_CUES), ("gender_hint", GENDER_HINTS)):
+            for label, words in cues.items():
+                self._add(feature, label, words)
+        for feature in ("emotion", "genre"):
+            for label in self.vocabularies[feature]:
+                if label not in _PLACEHOLDERS:
+                    self._add(feature, label, [label])
+        # instruments score every instrumentation label that contains them
+        self._instruments = {label: label.split(" and ") for label in instrumentations}
+        for instrument in {i for parts in self._instruments.values() for i in parts}:
+            self._add("instrument", instrument, INSTRUMENT_CUES.get(instrument, []) + [instrument])
+        for derived, feature in ((GENRE_INSTRUMENTATION, "instrumentation"), (EMOTION_TIMBRE, "timbre")):
+            for label in derived.values():
+                self._check(feature, label)
+        self._max_chars = max(map(len, self._chars), default=1)
+        self._max_words = max(map(len, self._words), default=1)
+
+    def _check(self, feature, label):
+        if feature == "gender_hint":
+            feature = "gender_suggestion"
+        if feature != "instrument" and label not in self.vocabularies[feature]:
+            raise ValueError(f"{label!r} is not a {feature} of the vocabulary")
+
+    def _add(self, feature, label, words):
+        self._check(feature, label)
+        for word in words:
+            word = word.lower()
+            if _CJK.fullmatch(word):
+                entries = self._chars.setdefault(word, [])
+            else:
+                entries = self._words.setdefault(tuple(_WORD.findall(word)), [])
+            if (feature, label) not in entries:
+                entries.append((feature, label))
+
+    def _hits(self, lyrics):
+        """Number of cue matches per (feature, label), every cue counted at most MAX_HITS times"""
+        text = _TAG.sub(" ", lyrics).lower()
+        cues = {}
+        for run in _CJK.findall(text):
+            for start in range(len(run)):
+                for n in range(1, min(self._max_chars, len(run) - start) + 1):
+                    gram = run[start:start + n]
+                    if gram in self._chars:
+                        cues[gram] = cues.get(gram, 0) + 1
+        words = _WORD.findall(text)
+        for start in range(len(words)):
+            for n in range(1, min(self._max_words, len(words) - start) + 1):
+                gram = tuple(words[start:start + n])
+                if gram in self._words:
+                    cues[gram] = cues.get(gram, 0) + 1
+        hits = {}
+        for cue, count in cues.items():
+            for entry in (self._chars if isinstance(cue, str) else self._words)[cue]:
+                hits[entry] = hits.get(entry, 0) + min(count, MAX_HITS)
+        return hits
+
+    def _best(self, feature, scores, weight=1.0):
+        """(label, confidence) of the best scored label, the first of the vocabulary wins ties"""
+        labels = self.vocabularies[feature]
+        if not scores:
+            return labels[0], 0.0
+        label = max(scores, key=lambda label: (scores[label], -labels.index(label)))
+        return label, weight * scores[label] / (sum(scores.values()) + PRIOR)
+
+    def analyze(self, lyrics):
+        """{feature: (label, confidence)} of the analyze_lyrics features, confidence in [0, 1)"""
+        hits = self._hits(lyrics)
+        scores = {feature: {} for feature in self.vocabularies}
+        for (feature, label), count in hits.items():
+            if feature in ("instrument", "gender_hint"):
+                continue
+            scores[feature][label] = scores[feature].get(label, 0) + count
+        # a label scores the hits of its instruments, scaled by the share of them that were named
+        for label, parts in self._instruments.items():
+            named = [hits[("instrument", part)] for part in parts if ("instrument", part) in hits]
+            if named:
+                scores["instrumentation"][label] = sum(named) * len(named) / len(parts)
+
+        result = {}
+        for feature in ("emotion", "genre"):
+            result[feature] = self._best(feature, scores[feature])
+        if not scores["genre"]:
+            # lyrics without genre cues are most likely pop
+            result["genre"] = ("pop", 0.0)
+        direct = bool(scores["gender_suggestion"])
+        for (feature, label), count in hits.items():
+            if feature == "gender_hint":
+                scores["gender_suggestion"][label] = scores["gender_suggestion"].get(label, 0) + HINT_WEIGHT * count
+        result["gender_suggestion"] = self._best("gender_suggestion", scores["gender_suggestion"],
+                                                 1.0 if direct else HINT_WEIGHT)
+        # the winning genre and emotion count as much as their own evidence
+        for feature, source, derived in (("instrumentation", "genre", GENRE_INSTRUMENTATION),
+                                         ("timbre", "emotion", EMOTION_TIMBRE)):
+            label = derived.get(result[source][0])
+            if not scores[feature]:
+                if label is not None:
+                    # nothing but the genre or emotion to go by
+                    result[feature] = (label, DERIVED_WEIGHT * result[source][1])
+                else:
+                    result[feature] = self._best(feature, scores[feature])
+                continue
+            if scores[source] and label is not None:
+                scores[feature][label] = scores[feature].get(label, 0) + max(scores[source].values())
+            result[feature] = self._best(feature, scores[feature])
+        return {feature: result[feature] for feature in self.vocabularies}
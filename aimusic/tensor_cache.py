@@ -0,0 +1,92 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+
+from . import config
+
+# elements hashed per tensor on top of the full-tensor sum
+_FINGERPRINT_SAMPLES = 1 << 16
+
+
+def tensor_fingerprint(tensor):
+    """
+    Content fingerprint of a tensor: shape, dtype and device, the float64 sum over all elements
+    and a hash of an evenly strided sample of them. Costs one read pass, far less than a resample.
+    Tensor-like inputs such as memory-mapped frames provide their own fingerprint().
+    """
+    if not isinstance(tensor, torch.Tensor):
+        return tensor.fingerprint()
+    flat = tensor.detach().reshape(-1)
+    step = max(1, flat.numel() // _FINGERPRINT_SAMPLES)
+    sample = flat[::step][:_FINGERPRINT_SAMPLES].cpu()
+    if sample.dtype == torch.bfloat16:  # no numpy equivalent
+        sample = sample.view(torch.int16)
+    digest = hashlib.blake2b(sample.numpy().tobytes(), digest_size=16)
+    digest.update(repr(torch.sum(flat, dtype=torch.float64).item()).encode())
+    return (tuple(tensor.shape), str(tensor.dtype), str(tensor.device), digest.hexdigest())
+
+
+def _nbytes(value):
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    return 0
+
+
+class TensorLRUCache:
+    """
+    Thread-safe LRU cache of tensors (or tuples of tensors) bounded by their total size in bytes.
+    Values larger than the budget are not cached, max_bytes=0 disables the cache.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = _nbytes(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= _nbytes(self._entries.pop(key))
+            if size > self.max_bytes:
+                return value
+            self._entries[key] = value
+            self.nbytes += size
+            self._evict()
+        return value
+
+    def set_max_bytes(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self._entries:
+            _, value = self._entries.popitem(last=False)
+            self.nbytes -= _nbytes(value)
+
+
+# resized end images, control frames and inpaint masks of the VACE nodes
+resize_cache = TensorLRUCache(int(config.get("resize_cache_mb") * 1024 * 1024))
+# memoized node outputs, only used by nodes run with memoize
+output_cache = TensorLRUCache(int(config.get("output_cache_mb") * 1024 * 1024))
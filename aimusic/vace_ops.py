@@ -0,0 +1,461 @@
+"""
+Tensor implementation of the VACE frame batch nodes. The node modules only import it when a node
+runs, so registering the nodes doesn't load torch, numpy or comfy.
+"""
+import hashlib
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+import numpy as np
+from comfy.utils import common_upscale
+from . import config
+from .tensor_cache import output_cache, resize_cache, tensor_fingerprint
+
+# Large CPU resizes run in chunks of this many frames spread over a thread pool, so the
+# temporary copies of the resampler are bounded by the chunk and not by the batch
+RESIZE_CHUNK_FRAMES = config.get("resize_chunk_frames")
+RESIZE_THREADS = config.get("resize_threads")
+_resize_pool = None
+# .npy file of the last chunked run that wrote to the temp directory, removed by the next one
+_last_temp_npy = None
+
+# numpy dtypes of the memory-mapped output files, bfloat16 is stored as its raw 16 bits
+_NPY_DTYPES = {torch.float32: np.float32, torch.float16: np.float16, torch.bfloat16: np.int16,
+               torch.uint8: np.uint8, torch.bool: np.bool_}
+
+# Resolved output size and frame placements, shared by the whole batch and the chunked windows.
+# placements: (first frame, frames) pairs in write order, placed: per-frame flags of those frames,
+# generate: per-frame flags of the frames VACE has to generate (mask == 1)
+# cache: whether resized inputs go through resize_cache, off for the chunked windows
+_Layout = namedtuple("_Layout", ["height", "width", "device", "dtype", "placements", "placed", "generate",
+                                 "control_images", "inpaint_mask", "cache"])
+
+
+def _as_tensor(frames, dtype):
+    """Memory-mapped control frames are read and converted here, tensors pass through"""
+    return frames if isinstance(frames, torch.Tensor) else frames.to(dtype)
+
+
+def _copy_chunk():
+    """Frames read, converted and resized at a time when filling a batch, enough for every resize thread"""
+    return max(RESIZE_CHUNK_FRAMES, 1) * max(RESIZE_THREADS, 1)
+
+
+def _copy_frames(out, frames):
+    """Write frames into the start of out, memory-mapped frames are read and converted one chunk at a time"""
+    if isinstance(frames, torch.Tensor):
+        out[:frames.shape[0]] = frames
+        return out
+    chunk = _copy_chunk()
+    for start in range(0, frames.shape[0], chunk):
+        part = frames[start:start + chunk]
+        out[start:start + part.shape[0]] = part.to(out.dtype)
+    return out
+
+
+def _output_dtype(output_dtype, keep_device, input_dtype):
+    if output_dtype == "auto":
+        return input_dtype if keep_device else torch.float32
+    return getattr(torch, output_dtype)
+
+
+def _to_npy(tensor):
+    return (tensor.view(torch.int16) if tensor.dtype == torch.bfloat16 else tensor).numpy()
+
+
+def _from_npy(array, dtype):
+    tensor = torch.from_numpy(array)
+    return tensor.view(torch.bfloat16) if dtype == torch.bfloat16 else tensor
+
+
+def expand_vace_mask(masks, height, width, dtype=torch.float32):
+    """
+    Expand a compact mask from WanVideoVACEStartToEndFrame to a dense (num_frames, height, width) mask.
+
+    Accepts every mask_format the node emits: per-frame flags of shape (num_frames, 1, 1) are broadcast
+    and uint8/bool masks are cast to dtype. The result is a broadcast view for per-frame masks, call
+    .contiguous() on it before writing into it.
+    """
+    return masks.to(dtype).expand(masks.shape[0], height, width)
+
+
+def _upscale(samples, width, height, mode):
+    """common_upscale on (B, C, H, W) samples, chunked over the resize thread pool for large CPU batches"""
+    global _resize_pool
+    batch, chunk = samples.shape[0], max(RESIZE_CHUNK_FRAMES, 1)
+    if samples.device.type != "cpu" or batch <= chunk:
+        return common_upscale(samples, width, height, mode, "disabled")
+
+    first = common_upscale(samples[:chunk], width, height, mode, "disabled")
+    out = torch.empty((batch,) + tuple(first.shape[1:]), dtype=first.dtype)
+    out[:chunk] = first
+
+    def resize_chunk(start):
+        out[start:start + chunk] = common_upscale(samples[start:start + chunk], width, height, mode, "disabled")
+
+    starts = range(chunk, batch, chunk)
+    if RESIZE_THREADS > 1:
+        if _resize_pool is None:
+            _resize_pool = ThreadPoolExecutor(max_workers=RESIZE_THREADS, thread_name_prefix="vace_resize")
+        list(_resize_pool.map(resize_chunk, starts))
+    else:
+        for start in starts:
+            resize_chunk(start)
+    return out
+
+
+def _cacheable(frames, width, height, channels, element_size):
+    """Whether a resize result fits resize_cache, checked before paying for the fingerprint"""
+    return frames * height * width * channels * element_size <= resize_cache.max_bytes
+
+
+def _resize_frames(images, width, height, mode, cache=True):
+    """Resize (B, H, W, C) images, with cache repeated runs with the same frames are served from resize_cache"""
+    if images.shape[1] == height and images.shape[2] == width:
+        return images
+    if not cache or not _cacheable(images.shape[0], width, height, images.shape[3], images.element_size()):
+        return _upscale(images.movedim(-1, 1), width, height, mode).movedim(1, -1)
+    key = ("frames", tensor_fingerprint(images), width, height, mode)
+    resized = resize_cache.get(key)
+    if resized is None:
+        resized = resize_cache.put(key, _upscale(images.movedim(-1, 1), width, height, mode).movedim(1, -1))
+    return resized
+
+
+def _resize_masks(masks, width, height, mode, cache=True):
+    """Resize (B, H, W) masks, with cache through resize_cache"""
+    if masks.shape[1] == height and masks.shape[2] == width:
+        return masks
+    if not cache or not _cacheable(masks.shape[0], width, height, 1, masks.element_size()):
+        return _upscale(masks.unsqueeze(1), width, height, mode).squeeze(1)
+    key = ("masks", tensor_fingerprint(masks), width, height, mode)
+    resized = resize_cache.get(key)
+    if resized is None:
+        resized = resize_cache.put(key, _upscale(masks.unsqueeze(1), width, height, mode).squeeze(1))
+    return resized
+
+
+def _reduce_frames(x, stride, leading_frame=True):
+    """
+    Downsample along the frame axis the way the causal video VAE does: the first frame is kept
+    on its own and every following group of stride frames is merged, a group counts as masked
+    if any of its frames is. (num_frames, ...) -> (ceil((num_frames - 1) / stride) + 1, ...)
+    leading_frame=False is for windows that start on a group boundary after the first frame.
+    """
+    if stride <= 1 or x.shape[0] <= (1 if leading_frame else 0):
+        return x
+    head, tail = (x[:1], x[1:]) if leading_frame else (x[:0], x)
+    pad = -tail.shape[0] % stride
+    if pad:
+        tail = torch.cat([tail, tail[-1:].expand(pad, *tail.shape[1:])])
+    tail = tail.reshape(-1, stride, *tail.shape[1:])
+    tail = tail.any(dim=1) if tail.dtype == torch.bool else tail.amax(dim=1)
+    return torch.cat([head, tail])
+
+
+def _format_masks(frame_mask, height, width, mask_format, dtype, inpaint_mask=None, temporal_stride=1,
+                  leading_frame=True):
+    """
+    Build the output masks from a per-frame flag vector (True where the frame has to be generated).
+
+    Without an inpaint mask every frame is all 0 or all 1, so the dense mask is only expanded for
+    the "float" format; "per_frame" keeps the flags as a (num_frames, 1, 1) mask. uint8/bool masks
+    hold 0/1 and binarize a soft inpaint mask at 0.5. height/width are the mask resolution,
+    temporal_stride > 1 reduces the frame axis to the latent frame count.
+    """
+    if inpaint_mask is None:
+        frame_mask = _reduce_frames(frame_mask, temporal_stride, leading_frame)
+        masks = frame_mask.view(-1, 1, 1)
+        if mask_format == "per_frame":
+            return masks.to(dtype)
+    else:
+        # a spatial inpaint mask needs the dense layout, also for "per_frame"
+        masks = inpaint_mask.to(dtype) * frame_mask.view(-1, 1, 1)
+        masks = _reduce_frames(masks, temporal_stride, leading_frame)
+    num_frames = masks.shape[0]
+    if mask_format in ("uint8", "bool"):
+        if masks.dtype != torch.bool:
+            masks = masks >= 0.5
+        if mask_format == "uint8":
+            masks = masks.to(torch.uint8)
+    else:
+        masks = masks.to(dtype)
+    masks = masks.expand(num_frames, height, width)
+    return masks.contiguous()
+
+
+def _layout(num_frames, start_image=None, end_image=None, control_images=None, inpaint_mask=None, start_index=0,
+            end_index=-1, dtype=None, cache=True):
+    """
+    Output size and placements of the batch. With cache the control video is resized whole and
+    kept in resize_cache; without, as for the chunked windows, every window resizes the control
+    frames it uses and nothing is kept.
+    """
+    if start_image is None and end_image is None:
+        # control images only: taken as they are, nothing is masked and the inpaint mask is unused
+        _, H, W, _ = control_images.shape
+        placements = [(0, control_images[:num_frames])]
+        placed = torch.zeros(num_frames, dtype=torch.bool, device=control_images.device)
+        placed[:control_images.shape[0]] = True
+        generate = torch.zeros(num_frames, dtype=torch.bool, device=control_images.device)
+        return _Layout(H, W, control_images.device, dtype or control_images.dtype, placements, placed, generate,
+                       None, None, cache)
+
+    B, H, W, C = start_image.shape if start_image is not None else end_image.shape
+    device = start_image.device if start_image is not None else end_image.device
+    dtype = dtype or (start_image if start_image is not None else end_image).dtype
+
+    # Convert negative end_index to positive
+    if end_index < 0:
+        end_index = num_frames + end_index
+
+    placements = []
+    # Place start image at start_index
+    if start_image is not None:
+        frames_to_copy = min(start_image.shape[0], num_frames - start_index)
+        if frames_to_copy > 0:
+            placements.append((start_index, start_image[:frames_to_copy]))
+
+    # Place end image at end_index, end images placed later win over the start images
+    if end_image is not None:
+        # Calculate where to start placing end images
+        end_start = end_index - end_image.shape[0] + 1
+        if end_start < 0:  # Handle case where end images won't all fit
+            end_image = end_image[abs(end_start):]
+            end_start = 0
+
+        frames_to_copy = min(end_image.shape[0], num_frames - end_start)
+        if frames_to_copy > 0:
+            # only the frames that are placed get resized
+            placements.append((end_start, _resize_frames(end_image[:frames_to_copy], W, H, "lanczos", cache)))
+
+    # Per-frame flag of frames taken by start/end images. The masks are built from it, and the
+    # control fill can be a single indexed copy instead of a loop
+    placed = torch.zeros(num_frames, dtype=torch.bool, device=device)
+    for first, frames in placements:
+        placed[first:first + frames.shape[0]] = True
+    if control_images is not None:
+        # frames past the batch are never used, slicing is free for tensors and memory-mapped frames
+        control_images = control_images[:num_frames]
+    if cache and isinstance(control_images, torch.Tensor):
+        # one cache entry per control video, whatever frames the placements leave to it.
+        # Memory-mapped control frames are only read where they are used, never whole
+        control_images = _resize_frames(control_images, W, H, "lanczos")
+    return _Layout(H, W, device, dtype, placements, placed, ~placed, control_images, inpaint_mask, cache)
+
+
+def _fill_frames(out, first, layout):
+    """Write frames [first, first + len(out)) of the batch into out, already filled with the empty level"""
+    last = first + out.shape[0]
+    for dst, frames in layout.placements:
+        lo, hi = max(dst, first), min(dst + frames.shape[0], last)
+        if lo < hi:
+            out[lo - first:hi - first] = _as_tensor(frames[lo - dst:hi - dst], out.dtype)
+
+    # Apply control images to remaining frames that don't have start or end images
+    control_images = layout.control_images
+    if control_images is not None:
+        # Only apply control images where they exist, frames not resized yet are resized as they are used
+        control_last = min(control_images.shape[0], last)
+        if first < control_last:
+            empty_idx = torch.nonzero(~layout.placed[first:control_last]).squeeze(1)
+            # in chunks, so the read, converted and resized copies stay bounded and not as large as out
+            chunk = _copy_chunk()
+            for lo in range(0, empty_idx.numel(), chunk):
+                idx = empty_idx[lo:lo + chunk]
+                control = control_images.index_select(0, idx.to(control_images.device) + first)
+                control = _resize_frames(control, layout.width, layout.height, "lanczos", cache=False)
+                out.index_copy_(0, idx.to(out.device), control.to(out))
+
+
+def _inpaint_frames(inpaint_mask, first, last, height, width, device, cache=True):
+    """
+    Inpaint mask for frames [first, last), truncated or tiled over the batch by frame index. Every
+    source frame that is used is resized once, before tiling.
+    """
+    idx = torch.arange(first, last, device=inpaint_mask.device) % inpaint_mask.shape[0]
+    if last - first >= inpaint_mask.shape[0]:
+        # every source frame is used, resize them once and tile by index
+        inpaint_mask = _resize_masks(inpaint_mask, width, height, "nearest-exact", cache).index_select(0, idx)
+    else:
+        # fewer frames than the source, each is used at most once
+        inpaint_mask = _resize_masks(inpaint_mask.index_select(0, idx), width, height, "nearest-exact", cache)
+    return inpaint_mask.to(device)
+
+
+def _window_bounds(num_frames, chunk_size, temporal_stride=1):
+    """Split [0, num_frames) in windows of about chunk_size frames that never split a latent frame group"""
+    if chunk_size <= 0 or chunk_size >= num_frames:
+        return [(0, num_frames)]
+    step = -(-chunk_size // temporal_stride) * temporal_stride
+    starts = [0] + list(range(1 + step, num_frames, step))
+    return list(zip(starts, starts[1:] + [num_frames]))
+
+
+def iter_vace_windows(num_frames, empty_frame_level, start_image=None, end_image=None, control_images=None,
+                      inpaint_mask=None, start_index=0, end_index=-1, chunk_size=81, mask_format="float",
+                      mask_spatial_stride=1, mask_temporal_stride=1, dtype=torch.float32, device=None):
+    """
+    Yield the WanVideoVACEStartToEndFrame batch as (first_frame, images, masks) windows of about
+    chunk_size frames, so peak memory is bounded by the window and not by num_frames.
+
+    Concatenating the windows gives the same frames and masks as the node. Window boundaries follow
+    mask_temporal_stride, so with a stride the masks of a window start at latent frame
+    (first_frame - 1) // mask_temporal_stride + 1.
+    """
+    # nothing is cached, a cache entry per window would hold on to the whole batch
+    layout = _layout(num_frames, start_image, end_image, control_images, inpaint_mask, start_index, end_index,
+                     dtype, cache=False)
+    device = device or layout.device
+    mask_h, mask_w = max(layout.height // mask_spatial_stride, 1), max(layout.width // mask_spatial_stride, 1)
+    for first, last in _window_bounds(num_frames, chunk_size, mask_temporal_stride):
+        images = torch.full((last - first, layout.height, layout.width, 3), empty_frame_level, dtype=layout.dtype,
+                            device=device)
+        _fill_frames(images, first, layout)
+        window_inpaint = None
+        if layout.inpaint_mask is not None:
+            window_inpaint = _inpaint_frames(layout.inpaint_mask, first, last, mask_h, mask_w, device, cache=False)
+        masks = _format_masks(layout.generate[first:last].to(device), mask_h, mask_w, mask_format, layout.dtype,
+                              window_inpaint, temporal_stride=mask_temporal_stride, leading_frame=first == 0)
+        yield first, images, masks
+
+
+def build_batch(num_frames, empty_frame_level, start_image=None, end_image=None, control_images=None,
+                inpaint_mask=None, start_index=0, end_index=-1, keep_device=False, mask_format="float",
+                mask_spatial_stride=1, mask_temporal_stride=1, output_dtype="auto"):
+    """The WanVideoVACEStartToEndFrame batch and masks, built in memory at once"""
+    if start_image is None and end_image is None and control_images is not None:
+        _, H, W, C = control_images.shape
+        dtype = _output_dtype(output_dtype, keep_device, control_images.dtype)
+        if control_images.shape[0] >= num_frames:
+            # a view, no copy for tensors, memory-mapped frames are read in chunks
+            control_images = control_images[:num_frames]
+            if not isinstance(control_images, torch.Tensor):
+                control_images = _copy_frames(torch.empty((num_frames, H, W, C), dtype=dtype), control_images)
+        elif control_images.shape[0] < num_frames:
+            # padd with empty_frame_level frames, filled once and written in place
+            padded = torch.full((num_frames, H, W, C), empty_frame_level, dtype=dtype, device=control_images.device)
+            control_images = _copy_frames(padded, control_images)
+        mask_device = control_images.device if keep_device else torch.device("cpu")
+        frame_mask = torch.zeros(num_frames, dtype=torch.bool, device=mask_device)
+        # materialized like the other masks, downstream nodes may write into them
+        masks = _format_masks(frame_mask, max(H // mask_spatial_stride, 1), max(W // mask_spatial_stride, 1),
+                              mask_format, dtype, temporal_stride=mask_temporal_stride)
+        if keep_device:
+            return (control_images.to(dtype), masks)
+        return (control_images.to(device="cpu", dtype=dtype), masks)
+    layout = _layout(num_frames, start_image, end_image, control_images, inpaint_mask, start_index, end_index,
+                     dtype=_output_dtype(output_dtype, keep_device,
+                                         (start_image if start_image is not None else end_image).dtype))
+    # masks are built straight on the output device, frames only move once
+    mask_device = layout.device if keep_device else torch.device("cpu")
+    # mask resolution, the latent grid when a stride is set
+    mask_h, mask_w = max(layout.height // mask_spatial_stride, 1), max(layout.width // mask_spatial_stride, 1)
+
+    # Create output batch with empty frames and write the start/end and control frames into it
+    out_batch = torch.full((num_frames, layout.height, layout.width, 3), empty_frame_level, dtype=layout.dtype,
+                           device=layout.device)
+    _fill_frames(out_batch, 0, layout)
+
+    # Apply inpaint mask if provided
+    if inpaint_mask is not None:
+        inpaint_mask = _inpaint_frames(inpaint_mask, 0, num_frames, mask_h, mask_w, mask_device)
+
+    # Build the masks from the placed frames and the inpaint mask in one operation
+    masks = _format_masks(layout.generate.to(mask_device), mask_h, mask_w, mask_format, layout.dtype,
+                          inpaint_mask, temporal_stride=mask_temporal_stride)
+
+    if keep_device:
+        return (out_batch, masks)
+    # a no-op for a batch built on the CPU
+    return (out_batch.cpu(), masks)
+
+
+def build_memoized(num_frames, empty_frame_level, start_image=None, end_image=None, control_images=None,
+                   inpaint_mask=None, start_index=0, end_index=-1, keep_device=False, mask_format="float",
+                   mask_spatial_stride=1, mask_temporal_stride=1, output_dtype="auto"):
+    """build_batch() through output_cache, for runs with identical inputs"""
+    key = ("output",) + tuple(tensor_fingerprint(t) if t is not None else None
+                              for t in (start_image, end_image, control_images, inpaint_mask)) + \
+        (num_frames, empty_frame_level, start_index, end_index, keep_device, mask_format, mask_spatial_stride,
+         mask_temporal_stride, output_dtype)
+    cached = output_cache.get(key)
+    if cached is not None:
+        outputs, versions = cached[:2], cached[2]
+        # copy-on-write: the outputs are shared with downstream nodes, if one of them wrote
+        # into them (their version counter moved) the entry is stale and gets rebuilt
+        if tuple(t._version for t in outputs) == versions:
+            return outputs
+    outputs = build_batch(num_frames, empty_frame_level, start_image, end_image, control_images, inpaint_mask,
+                          start_index, end_index, keep_device, mask_format, mask_spatial_stride,
+                          mask_temporal_stride, output_dtype)
+    output_cache.put(key, outputs + (tuple(t._version for t in outputs),))
+    return outputs
+
+
+def _temp_npy(params, inputs):
+    """
+    Temp directory path of a chunked output, named after its inputs so a rerun overwrites its file.
+    The files of the previous run with other inputs are deleted, at most one run stays on disk.
+    """
+    global _last_temp_npy
+    import folder_paths
+    key = repr(params) + repr(sorted((name, tensor_fingerprint(value) if value is not None and
+                                      not isinstance(value, int) else value) for name, value in inputs.items()))
+    path = os.path.join(folder_paths.get_temp_directory(),
+                        f"vace_frames_{hashlib.sha256(key.encode()).hexdigest()[:16]}.npy")
+    if _last_temp_npy is not None and _last_temp_npy != path:
+        for old in (_last_temp_npy, os.path.splitext(_last_temp_npy)[0] + "_masks.npy"):
+            try:
+                os.remove(old)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                # still mapped by a tensor of the previous run on Windows, ComfyUI clears it on restart
+                print(f"Error: could not remove {old}: {e}")
+    _last_temp_npy = path
+    return path
+
+
+def write_chunked(num_frames, empty_frame_level, chunk_size, output_npy="", mask_format="float",
+                  mask_spatial_stride=1, mask_temporal_stride=1, dtype=torch.float32, **inputs):
+    """
+    Write the batch window by window into a memory-mapped .npy file and return tensors
+    backed by it, so peak memory is bounded by chunk_size and not by num_frames. Dense masks go
+    to a second *_masks.npy file, per-frame masks are small and stay in memory.
+    """
+    if not output_npy:
+        output_npy = _temp_npy((num_frames, empty_frame_level, mask_format, mask_spatial_stride,
+                                mask_temporal_stride, str(dtype)), inputs)
+    frames = masks = None
+    mask_parts = []
+    for first, images, window_masks in iter_vace_windows(num_frames, empty_frame_level, chunk_size=chunk_size,
+                                                          mask_format=mask_format,
+                                                          mask_spatial_stride=mask_spatial_stride,
+                                                          mask_temporal_stride=mask_temporal_stride,
+                                                          dtype=dtype, device=torch.device("cpu"),
+                                                          **inputs):
+        if frames is None:
+            frames = np.lib.format.open_memmap(output_npy, mode="w+", dtype=_NPY_DTYPES[dtype],
+                                               shape=(num_frames,) + tuple(images.shape[1:]))
+        frames[first:first + images.shape[0]] = _to_npy(images)
+
+        if window_masks.shape[1:] == (1, 1):
+            mask_parts.append(window_masks)
+            continue
+        if masks is None:
+            mask_dtype = window_masks.dtype
+            mask_frames = -(-(num_frames - 1) // mask_temporal_stride) + 1
+            masks = np.lib.format.open_memmap(os.path.splitext(output_npy)[0] + "_masks.npy", mode="w+",
+                                              dtype=_NPY_DTYPES[window_masks.dtype],
+                                              shape=(mask_frames,) + tuple(window_masks.shape[1:]))
+        mask_first = (first - 1) // mask_temporal_stride + 1 if first > 0 else 0
+        masks[mask_first:mask_first + window_masks.shape[0]] = _to_npy(window_masks)
+
+    frames.flush()
+    if masks is None:
+        return (_from_npy(frames, dtype), torch.cat(mask_parts))
+    masks.flush()
+    return (_from_npy(frames, dtype), _from_npy(masks, mask_dtype))
@@ -0,0 +1,174 @@
+"""
+CPU benchmark of WanVideoVACEStartToEndFrame.process.
+
+Runs every (resolution, frame count, input combination) case in its own process and prints one
+JSON document with wall time, peak RSS, bytes allocated by torch ops and the number of full-size
+(num_frames x H x W or larger) tensor allocations per case, so memory and latency regressions of
+the node show up in a diff. No GPU is needed.
+
+    python benchmarks/bench_wan_vace.py --comfyui /path/to/ComfyUI --output bench_output.json
+    python benchmarks/bench_wan_vace.py --comfyui ../.. --resolutions 480p --frames 81 321 \\
+        --option mask_format=per_frame --option keep_device=true
+"""
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RESOLUTIONS = {"480p": (832, 480), "720p": (1280, 720), "1080p": (1920, 1080)}
+FRAME_COUNTS = [81, 321, 1001, 10000]
+CASES = ["start_only", "start_end", "control_only", "control_inpaint"]
+
+
+def _case_inputs(case, num_frames, width, height):
+    """Inputs of a case, control videos and inpaint masks deliberately don't match the output size"""
+    import torch
+    generator = torch.Generator().manual_seed(0)
+
+    def rand(*shape):
+        return torch.rand(*shape, generator=generator)
+
+    start_image = rand(1, height, width, 3)
+    if case == "start_only":
+        return {"start_image": start_image}
+    if case == "start_end":
+        return {"start_image": start_image, "end_image": rand(1, height, width, 3)}
+    control_images = rand(num_frames, height // 2, width // 2, 3)
+    if case == "control_only":
+        return {"control_images": control_images}
+    return {"start_image": start_image, "control_images": control_images,
+            "inpaint_mask": (rand(16, height // 4, width // 4) > 0.5).float()}
+
+
+def _estimated_bytes(case, num_frames, width, height):
+    frame = width * height * 4
+    inputs = {"start_only": frame * 3, "start_end": frame * 6, "control_only": num_frames * frame * 3 // 4,
+              "control_inpaint": num_frames * frame * 3 // 4 + frame * 4}[case]
+    # inputs, the batch and the mask, plus the resized control frames
+    return inputs + num_frames * frame * 4 + (num_frames * frame * 3 if "control" in case else 0)
+
+
+def _rss_bytes():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _run_case(comfyui, case, num_frames, width, height, options, repeat, queue):
+    sys.path[:0] = [comfyui, os.path.dirname(PLUGIN_DIR)]
+    import torch
+    from torch.utils._python_dispatch import TorchDispatchMode
+    from torch.utils._pytree import tree_leaves
+
+    package = os.path.basename(PLUGIN_DIR)
+    node = importlib.import_module(f"{package}.aimusic.WanVideoVACEStartToEndFrame").WanVideoVACEStartToEndFrame()
+    resize_cache = importlib.import_module(f"{package}.aimusic.tensor_cache").resize_cache
+    inputs = _case_inputs(case, num_frames, width, height)
+    full_size = num_frames * width * height
+
+    class AllocationCounter(TorchDispatchMode):
+        def __init__(self):
+            super().__init__()
+            self.bytes = 0
+            self.full_size = 0
+
+        def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+            kwargs = kwargs or {}
+            out = func(*args, **kwargs)
+            # views and in-place ops return storage of their inputs, only count new storage
+            inputs = {t.untyped_storage().data_ptr() for t in tree_leaves((args, kwargs))
+                      if isinstance(t, torch.Tensor)}
+            for tensor in tree_leaves(out):
+                if isinstance(tensor, torch.Tensor) and tensor.untyped_storage().data_ptr() not in inputs:
+                    self.bytes += tensor.numel() * tensor.element_size()
+                    self.full_size += tensor.numel() >= full_size
+            return out
+
+    rss_inputs = _rss_bytes()
+    times = []
+    for _ in range(repeat):
+        resize_cache.clear()
+        start = time.perf_counter()
+        node.process(num_frames, 0.5, **inputs, **options)
+        times.append(time.perf_counter() - start)
+    rss_peak = _rss_bytes()
+
+    resize_cache.clear()
+    counter = AllocationCounter()
+    with counter:
+        node.process(num_frames, 0.5, **inputs, **options)
+    queue.put({"wall_time_s": min(times), "wall_time_median_s": statistics.median(times),
+               "peak_rss_bytes": rss_peak, "input_rss_bytes": rss_inputs, "torch_alloc_bytes": counter.bytes,
+               "full_size_allocations": counter.full_size})
+
+
+def _parse_option(option):
+    key, value = option.split("=", 1)
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--comfyui", default=os.path.dirname(os.path.dirname(PLUGIN_DIR)),
+                        help="ComfyUI root, defaults to the ComfyUI the plugin is installed in")
+    parser.add_argument("--resolutions", nargs="+", default=list(RESOLUTIONS), choices=list(RESOLUTIONS))
+    parser.add_argument("--frames", nargs="+", type=int, default=FRAME_COUNTS)
+    parser.add_argument("--cases", nargs="+", default=CASES, choices=CASES)
+    parser.add_argument("--option", action="append", default=[], metavar="KEY=VALUE",
+                        help="extra node input, the value is parsed as JSON if possible")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--max-gb", type=float, default=8.0,
+                        help="skip cases whose estimated memory use is above this")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    import torch
+    options = dict(_parse_option(option) for option in args.option)
+    ctx = multiprocessing.get_context("spawn")
+    results = []
+    for resolution in args.resolutions:
+        width, height = RESOLUTIONS[resolution]
+        for num_frames in args.frames:
+            for case in args.cases:
+                result = {"case": case, "resolution": resolution, "width": width, "height": height,
+                          "num_frames": num_frames, "options": options}
+                estimate = _estimated_bytes(case, num_frames, width, height)
+                if estimate > args.max_gb * 1024 ** 3:
+                    result["skipped"] = f"estimated {estimate / 1024 ** 3:.1f} GB > --max-gb {args.max_gb}"
+                else:
+                    queue = ctx.Queue()
+                    process = ctx.Process(target=_run_case, args=(args.comfyui, case, num_frames, width, height,
+                                                                  options, args.repeat, queue))
+                    process.start()
+                    process.join()
+                    if process.exitcode == 0:
+                        result.update(queue.get())
+                    else:
+                        result["error"] = f"exit code {process.exitcode}"
+                print(f"{case} {resolution} {num_frames}: {result.get('wall_time_s', result.get('skipped'))}",
+                      file=sys.stderr)
+                results.append(result)
+
+    report = json.dumps({"meta": {"python": platform.python_version(), "torch": torch.__version__,
+                                  "threads": torch.get_num_threads(), "platform": platform.platform()},
+                         "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
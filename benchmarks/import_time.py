@@ -0,0 +1,62 @@
+"""
+Import cost of the plugin, measured with python -X importtime in a fresh interpreter.
+
+Reports the cumulative import time of the plugin package and its slowest modules as JSON, and
+fails (exit code 1) when the import loads a heavy module that should only load on first node
+execution, or takes longer than --max-ms.
+
+    python benchmarks/import_time.py --comfyui /path/to/ComfyUI --max-ms 50
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["torch", "numpy", "comfy", "openai", "folder_paths"]
+
+
+def measure(comfyui):
+    package = os.path.basename(PLUGIN_DIR)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(PLUGIN_DIR), comfyui]))
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {package}"], env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {package} failed:\n{result.stderr}")
+
+    modules = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line.split(":", 1)[1].split("|")]
+        modules[name] = {"self_us": int(self_us), "cumulative_us": int(cumulative_us)}
+    return package, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--comfyui", default=os.path.dirname(os.path.dirname(PLUGIN_DIR)),
+                        help="ComfyUI root, defaults to the ComfyUI the plugin is installed in")
+    parser.add_argument("--max-ms", type=float, default=None, help="fail above this cumulative import time")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest modules to report")
+    args = parser.parse_args()
+
+    package, modules = measure(args.comfyui)
+    total_ms = modules[package]["cumulative_us"] / 1000
+    heavy = sorted(name for name in modules if name.split(".")[0] in HEAVY_MODULES)
+    slowest = sorted(modules.items(), key=lambda item: item[1]["self_us"], reverse=True)[:args.top]
+    print(json.dumps({"package": package, "cumulative_ms": total_ms, "heavy_modules": heavy,
+                      "slowest": [{"module": name, **times} for name, times in slowest]}, indent=2))
+
+    if heavy:
+        print(f"plugin import loads {', '.join(heavy)}", file=sys.stderr)
+        sys.exit(1)
+    if args.max_ms is not None and total_ms > args.max_ms:
+        print(f"plugin import took {total_ms:.1f} ms > --max-ms {args.max_ms}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()